@@ -0,0 +1,63 @@
+# Measures how much memory loaded assignments hold: the raw Canvas JSON dicts
+# the sync used to keep versus the slotted Assignment records it keeps now.
+#
+#   python benchmarks/bench_assignment_memory.py [--assignments 5000]
+import argparse
+import gc
+import json
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import easy_run  # noqa: E402
+from mock_server import canvas_assignment  # noqa: E402
+
+
+# Bytes still allocated after building the result of fn(payload)
+def retained(fn, payload):
+    gc.collect()
+    tracemalloc.start()
+    result = fn(payload)
+    gc.collect()
+    size, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, size, peak
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--assignments", type=int, default=5000)
+    args = parser.parse_args()
+
+    raw = [
+        canvas_assignment(n % 20, n, due_at="2030-01-01T06:59:00Z")
+        for n in range(args.assignments)
+    ]
+    payload = json.dumps(raw)
+    trimmed = json.dumps(
+        [
+            {k: v for k, v in item.items() if k not in ("description", "rubric")}
+            for item in raw
+        ]
+    )
+    del raw
+
+    dicts, dict_size, dict_peak = retained(json.loads, payload)
+    del dicts
+    records, record_size, record_peak = retained(
+        lambda body: [easy_run.Assignment.from_canvas(item) for item in json.loads(body)],
+        trimmed,
+    )
+    assert len(records) == args.assignments
+
+    print(f"{args.assignments} assignments")
+    print(f"Response body:      {len(payload) / 1e6:8.2f} MB full, {len(trimmed) / 1e6:.2f} MB trimmed")
+    print(f"Raw JSON dicts:     {dict_size / 1e6:8.2f} MB retained, {dict_peak / 1e6:.2f} MB peak")
+    print(f"Assignment records: {record_size / 1e6:8.2f} MB retained, {record_peak / 1e6:.2f} MB peak")
+    print(f"Reduction:          {dict_size / record_size:8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
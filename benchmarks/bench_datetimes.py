@@ -0,0 +1,129 @@
+# Synthetic benchmark for the date handling on the assignment path: parsing
+# Canvas timestamps, the past due / locked / no due date filters and rendering
+# task descriptions. Compares the old per-stage strptime path with the
+# parse-once records and cached rendering.
+#
+#   python benchmarks/bench_datetimes.py [--assignments 50000]
+import argparse
+import os
+import sys
+import time
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import easy_run  # noqa: E402
+from mock_server import canvas_assignment  # noqa: E402
+
+CONFIG = {
+    "sync_no_due_date_assignments": True,
+    "sync_null_assignments": False,
+    "sync_locked_assignments": False,
+}
+
+
+def make_fixture(count, course_count=20):
+    now = datetime.now(timezone.utc).replace(second=0, microsecond=0)
+    raw = []
+    for n in range(count):
+        # A term's worth of due dates at a handful of times of day, a tenth of
+        # them past due and a few with no due date or a future unlock date
+        due = now + timedelta(days=n % 120 - 12, hours=(n % 4) * 6)
+        item = canvas_assignment(n % course_count, n, due_at=due.strftime("%Y-%m-%dT%H:%M:%SZ"))
+        if n % 50 == 0:
+            item["due_at"] = None
+        if n % 40 == 0:
+            item["unlock_at"] = (now + timedelta(days=10)).strftime("%Y-%m-%dT%H:%M:%SZ")
+        raw.append(item)
+    return raw
+
+
+# The filter, description and due date handling as they were before Assignment
+# records, working on the raw dicts
+def legacy_pass(raw):
+    now_utc = datetime.now(timezone.utc)
+    kept = 0
+    for assignment in raw:
+        due_at_str = assignment.get("due_at")
+        due_at_dt = None
+        if due_at_str is not None:
+            due_at_dt = datetime.strptime(due_at_str, "%Y-%m-%dT%H:%M:%SZ")
+            due_at_dt = due_at_dt.replace(tzinfo=timezone.utc)
+            if due_at_dt <= now_utc:
+                continue
+        elif CONFIG["sync_no_due_date_assignments"] == False:
+            continue
+        if CONFIG["sync_null_assignments"] == False and assignment["submission_types"][0] in (
+            "not_graded",
+            "none",
+            "on_paper",
+        ):
+            continue
+        if (
+            assignment["unlock_at"] is not None
+            and CONFIG["sync_locked_assignments"] == False
+            and assignment["unlock_at"] > (datetime.now() + timedelta(days=3)).isoformat()
+        ):
+            continue
+        legacy_description(due_at_dt)
+        # add_new_task parsed the due date again
+        if assignment["due_at"]:
+            datetime.strptime(assignment["due_at"], "%Y-%m-%dT%H:%M:%SZ")
+        legacy_description(due_at_dt)
+        kept += 1
+    return kept
+
+
+def legacy_description(due_dt):
+    if due_dt is not None:
+        mt_dt = due_dt.astimezone(ZoneInfo("America/Phoenix"))
+        return f"Due: {mt_dt.strftime('%b %d, %Y at %I:%M %p %Z')}"
+    return "Due: No due date"
+
+
+def current_pass(raw, account):
+    easy_run.parse_canvas_time.cache_clear()
+    easy_run.format_task_description.cache_clear()
+    records = [easy_run.Assignment.from_canvas(item) for item in raw]
+    kept = 0
+    for assignment, _, _ in easy_run.filter_assignments(account, records, Counter()):
+        easy_run.format_task_description(assignment.due_at)
+        easy_run.format_task_description(assignment.due_at)
+        kept += 1
+    return kept
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--assignments", type=int, default=50000)
+    args = parser.parse_args()
+
+    raw = make_fixture(args.assignments)
+    account = easy_run.Account()
+    account.config = CONFIG
+    account.courses_id_name_dict.update({n: f"Course {n}" for n in range(20)})
+    account.course_project_ids.update({n: str(n) for n in range(20)})
+    account.log = lambda message: None
+
+    legacy_count, legacy_time = timed(legacy_pass, raw)
+    current_count, current_time = timed(current_pass, raw, account)
+    print(f"{len(raw)} assignments, {current_count} kept")
+    print(f"Per-stage strptime: {legacy_time:8.3f} s")
+    print(f"Parse once:         {current_time:8.3f} s (includes building the records)")
+    print(f"Speedup:            {legacy_time / current_time:8.1f}x")
+    # The old unlock check compared Canvas' UTC string with a local naive
+    # timestamp, so the counts can differ by the local UTC offset
+    if legacy_count != current_count:
+        print(f"Old path kept {legacy_count}")
+
+
+if __name__ == "__main__":
+    main()
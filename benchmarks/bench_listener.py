@@ -0,0 +1,145 @@
+# Measures listen mode: a listener (python easy_run.py listen) runs against the
+# local mock, assignments are renamed in the mock and a Canvas Live Event naming
+# each is posted to the listener. Reports the time from event to renamed task and
+# the requests each event cost, next to whole syncs picking up the same change.
+#
+#   python benchmarks/bench_listener.py [--events 5] [--latency 0.02] [--debounce 0.5]
+import argparse
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+import requests
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.join(BENCHMARKS, "..")
+sys.path.insert(0, BENCHMARKS)
+
+from bench_startup import run_process  # noqa: E402
+from bench_sync import make_semester  # noqa: E402
+from mock_server import MockState, start_mock_server  # noqa: E402
+
+
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+# Starts easy_run.py listen in a new process, pointed at the mock Todoist, and
+# returns once its first full sync has finished
+def start_listener(workdir, mock_url, port, debounce):
+    code = (
+        f"import sys; sys.path.insert(0, {os.path.abspath(ROOT)!r}); "
+        f"sys.argv = ['easy_run.py', 'listen', '--port', '{port}', '--debounce', '{debounce}']; "
+        f"import easy_run; easy_run.todoist_sync_url = {mock_url + '/todoist/api/v1/sync'!r}; "
+        "easy_run.main()"
+    )
+    process = subprocess.Popen(
+        [sys.executable, "-u", "-c", code], cwd=workdir, stdout=subprocess.PIPE, text=True
+    )
+    for line in process.stdout:
+        if line.startswith("Last Grade Update"):
+            break
+    return process
+
+
+# Renames an assignment that has a task, as a teacher editing it would
+def rename_assignment(state, course_id, n):
+    item = next(item for item in state.assignments[course_id] if item["due_at"] and item["due_at"] > now())
+    item["name"] = f"Renamed {n} {item['id']}"
+    item["updated_at"] = now()
+    return item
+
+
+def now():
+    return datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def wait_for_task(state, name, timeout=30):
+    deadline = time.perf_counter() + timeout
+    while not any(name in task["content"] for task in list(state.tasks.values())):
+        if time.perf_counter() >= deadline:
+            return False
+        time.sleep(0.005)
+    return True
+
+
+def split(sent):
+    canvas = sum(1 for _, path, _, _ in sent if path.startswith("/api/"))
+    return canvas, len(sent) - canvas
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--events", type=int, default=5)
+    parser.add_argument("--latency", type=float, default=0.02)
+    parser.add_argument("--debounce", type=float, default=0.5)
+    args = parser.parse_args()
+
+    state = MockState(*make_semester(8, 60), latency=args.latency)
+    state.add_course_projects()
+    _, url = start_mock_server(state)
+    workdir = tempfile.mkdtemp()
+    with open(os.path.join(workdir, "config.json"), "w") as config_file:
+        json.dump(
+            {
+                "todoist_api_key": "mock",
+                "canvas_api_key": "mock",
+                "canvas_api_heading": url,
+                "todoist_task_labels": [],
+                "sync_null_assignments": False,
+                "sync_locked_assignments": False,
+                "sync_no_due_date_assignments": True,
+                "courses": [str(course["id"]) for course in state.courses],
+            },
+            config_file,
+        )
+    port = free_port()
+    listener = start_listener(workdir, url, port, args.debounce)
+
+    latencies = []
+    costs = []
+    for n in range(args.events):
+        course_id = state.courses[n % len(state.courses)]["id"]
+        item = rename_assignment(state, course_id, n)
+        before = len(state.requests)
+        start = time.perf_counter()
+        requests.post(
+            f"http://127.0.0.1:{port}/canvas",
+            json={
+                "metadata": {"event_name": "assignment_updated", "context_type": "Course", "context_id": str(course_id)},
+                "body": {"assignment_id": str(item["id"]), "context_type": "Course", "context_id": str(course_id)},
+            },
+        )
+        if not wait_for_task(state, item["name"]):
+            exit("The listener did not rename the task")
+        latencies.append(time.perf_counter() - start)
+        time.sleep(args.debounce + 0.5)  # Let the rest of the pass finish
+        costs.append(split(state.requests[before:]))
+    listener.terminate()
+    listener.wait()
+
+    print(f"{len(state.courses)} courses, {args.latency * 1000:.0f} ms latency, {args.debounce} s debounce")
+    print(
+        f"  {'listen, one event':<28} {statistics.median(latencies):6.3f} s event to task, "
+        f"{statistics.median(c for c, _ in costs):.0f} canvas + {statistics.median(t for _, t in costs):.0f} todoist requests"
+    )
+    for label, flags in (("python easy_run.py", []), ("python easy_run.py --quick", ["--quick"])):
+        item = rename_assignment(state, state.courses[0]["id"], label)
+        before = len(state.requests)
+        elapsed = run_process(workdir, url, *flags)
+        if not wait_for_task(state, item["name"], timeout=0):
+            exit(f"{label} did not rename the task")
+        canvas, todoist = split(state.requests[before:])
+        print(f"  {label:<28} {elapsed:6.3f} s whole run,     {canvas} canvas + {todoist} todoist requests")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+# Synthetic benchmark for matching Canvas assignments to Todoist tasks.
+# Compares the old nested scan over todoist_tasks with the prebuilt index.
+#
+#   python benchmarks/bench_matching.py [--tasks 10000] [--assignments 2000]
+import argparse
+import os
+import sys
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import easy_run  # noqa: E402
+
+CANVAS = "https://canvas.example.edu"
+
+
+def make_fixture(task_count, assignment_count, project_count=20):
+    assignments = []
+    for i in range(assignment_count):
+        course_id = i % project_count
+        assignments.append(
+            SimpleNamespace(
+                name=f"Assignment {i}",
+                html_url=f"{CANVAS}/courses/{course_id}/assignments/{i}",
+                course_id=course_id,
+            )
+        )
+    tasks = []
+    # Half of the assignments are already synced, the rest of the account is
+    # unrelated tasks spread across the same projects
+    for assignment in assignments[::2]:
+        tasks.append(
+            SimpleNamespace(
+                id=str(len(tasks)),
+                project_id=str(assignment.course_id),
+                content=easy_run.task_content(assignment),
+                description="Due: No due date",
+            )
+        )
+    while len(tasks) < task_count:
+        tasks.append(
+            SimpleNamespace(
+                id=str(len(tasks)),
+                project_id=str(len(tasks) % project_count),
+                content=f"Unrelated task {len(tasks)}",
+                description="",
+            )
+        )
+    return assignments, tasks
+
+
+# The matching loop as it was before index_todoist_tasks existed
+def legacy_match(assignments, tasks):
+    matched = 0
+    for assignment in assignments:
+        project_id = str(assignment.course_id)
+        for task in tasks:
+            task_content = f"[{assignment.name}]({assignment.html_url}) Due"
+            if task.project_id == project_id and task.content == task_content:
+                matched += 1
+                break
+    return matched
+
+
+def indexed_match(assignments, tasks):
+    account = easy_run.Account()
+    easy_run.index_todoist_tasks(account, tasks)
+    matched = 0
+    for assignment in assignments:
+        if easy_run.find_todoist_task(account, assignment, str(assignment.course_id)):
+            matched += 1
+    return matched
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tasks", type=int, default=10000)
+    parser.add_argument("--assignments", type=int, default=2000)
+    args = parser.parse_args()
+
+    assignments, tasks = make_fixture(args.tasks, args.assignments)
+    print(f"{len(tasks)} tasks x {len(assignments)} assignments")
+    legacy_count, legacy_time = timed(legacy_match, assignments, tasks)
+    indexed_count, indexed_time = timed(indexed_match, assignments, tasks)
+    assert legacy_count == indexed_count, (legacy_count, indexed_count)
+    print(f"Matched: {indexed_count}")
+    print(f"Nested scan:   {legacy_time:8.3f} s")
+    print(f"Indexed match: {indexed_time:8.3f} s (includes building the index)")
+    print(f"Speedup:       {legacy_time / indexed_time:8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
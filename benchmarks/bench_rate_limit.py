@@ -0,0 +1,71 @@
+# Exercises the Canvas and Todoist rate limiters against the local mock server.
+#
+#   python benchmarks/bench_rate_limit.py
+#
+# Canvas: 12 courses x 5 pages through a tiny bucket that would overflow
+# without pacing. Todoist: 20 requests against a 10 per 2 seconds limit, which
+# must be absorbed by Retry-After backoff instead of failing.
+import os
+import sys
+import time
+
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import easy_run  # noqa: E402
+from mock_server import MockState, canvas_assignment, start_mock_server  # noqa: E402
+
+
+def main():
+    courses = [{"id": i, "name": f"Course {i}"} for i in range(1, 13)]
+    assignments = {
+        course["id"]: [canvas_assignment(course["id"], course["id"] * 1000 + n) for n in range(50)]
+        for course in courses
+    }
+    state = MockState(
+        courses=courses,
+        assignments=assignments,
+        page_size=10,
+        latency=0.02,
+        canvas_capacity=120,
+        canvas_leak_rate=40,
+        canvas_cost=10,
+        todoist_limit=10,
+        todoist_window=2,
+    )
+    server, url = start_mock_server(state)
+
+    account = easy_run.Account(use_cache=False)
+    account.config = {"canvas_api_heading": url, "canvas_max_workers": 6}
+    account.course_ids[:] = [course["id"] for course in courses]
+    account.courses_id_name_dict.update({c["id"]: c["name"] for c in courses})
+    # Scale the limiters to the mock bucket and window
+    easy_run.canvas_preflight_cost = 10
+    account.canvas_limiter = easy_run.RateLimiter("Canvas", rate=40, burst=120)
+
+    start = time.perf_counter()
+    loaded = list(easy_run.stream_assignments(account))
+    elapsed = time.perf_counter() - start
+    counts = state.status_counts()
+    assert len(loaded) == 12 * 50, len(loaded)
+    print(f"Canvas: {elapsed:.2f} s, responses {counts}, throttled {account.canvas_limiter.throttled:.2f} s")
+
+    state.requests.clear()
+    session = requests.Session()
+
+    def post():
+        response = session.post(f"{url}/todoist/tasks", json={})
+        response.raise_for_status()
+        return response.json()
+
+    start = time.perf_counter()
+    for _ in range(20):
+        easy_run.todoist_request(account, post)
+    elapsed = time.perf_counter() - start
+    print(f"Todoist: {elapsed:.2f} s, responses {state.status_counts()}, throttled {account.todoist_limiter.throttled:.2f} s")
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
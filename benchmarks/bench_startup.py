@@ -0,0 +1,110 @@
+# Measures what a scheduled run costs when there is nothing to do: the import
+# time of easy_run (as reported by python -X importtime) and the wall time and
+# requests of a whole `python easy_run.py` process against the local mock
+# server, for a normal sync and for a --quick one, which checks for changes
+# with two requests and without importing requests.
+#
+#   python benchmarks/bench_startup.py [--runs 5] [--latency 0.02]
+import argparse
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import requests
+
+BENCHMARKS = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.join(BENCHMARKS, "..")
+sys.path.insert(0, BENCHMARKS)
+
+from bench_sync import make_semester  # noqa: E402
+from mock_server import MockState, start_mock_process  # noqa: E402
+
+
+# Cumulative import time in ms of the modules imported by code, keyed by
+# (nesting level, name); level 0 are the modules code imports itself. Modules
+# imported at startup (by site and .pth files) are left out
+def import_times(code):
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        match = re.match(r"import time:\s+\d+ \|\s+(\d+) \| ( *)(\S+)", line)
+        if match:
+            times[len(match.group(2)) // 2, match.group(3)] = int(match.group(1)) / 1000
+            if match.group(3) == "site" and not match.group(2):
+                times.clear()
+    return times
+
+
+# Runs easy_run.py in a new process, pointed at the mock Todoist
+def run_process(workdir, mock_url, *args):
+    code = (
+        f"import sys; sys.path.insert(0, {os.path.abspath(ROOT)!r}); "
+        f"sys.argv = ['easy_run.py'] + {list(args)!r}; "
+        f"import easy_run; easy_run.todoist_sync_url = {mock_url + '/todoist/api/v1/sync'!r}; "
+        "easy_run.main()"
+    )
+    start = time.perf_counter()
+    subprocess.run([sys.executable, "-c", code], cwd=workdir, capture_output=True, check=True)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--latency", type=float, default=0.02)
+    args = parser.parse_args()
+
+    startup = statistics.median(
+        import_times("import easy_run")[0, "easy_run"] for _ in range(args.runs)
+    )
+    heaviest = sorted(
+        ((ms, name) for (level, name), ms in import_times("import easy_run").items() if level == 1),
+        reverse=True,
+    )
+    print(f"Import easy_run: {startup:7.1f} ms")
+    print("Heaviest imports: " + ", ".join(f"{name} {ms:.0f} ms" for ms, name in heaviest[:5]))
+
+    state = MockState(*make_semester(8, 60), latency=args.latency)
+    state.add_course_projects()
+    _, url = start_mock_process(state)
+    workdir = tempfile.mkdtemp()
+    with open(os.path.join(workdir, "config.json"), "w") as config_file:
+        json.dump(
+            {
+                "todoist_api_key": "mock",
+                "canvas_api_key": "mock",
+                "canvas_api_heading": url,
+                "todoist_task_labels": [],
+                "sync_null_assignments": False,
+                "sync_locked_assignments": False,
+                "sync_no_due_date_assignments": True,
+                "courses": [str(course["id"]) for course in state.courses],
+            },
+            config_file,
+        )
+    run_process(workdir, url)  # First run fills Todoist and the state store
+    # The first --quick run stores the fingerprint of the Canvas planner items
+    # later ones compare with
+    run_process(workdir, url, "--quick")
+
+    print(f"\nNo-op runs against the mock ({len(state.courses)} courses, {args.latency * 1000:.0f} ms latency):")
+    for label, flags in (("python easy_run.py", []), ("python easy_run.py --quick", ["--quick"])):
+        before = len(requests.get(f"{url}/_mock/requests").json())
+        times = [run_process(workdir, url, *flags) for _ in range(args.runs)]
+        sent = (len(requests.get(f"{url}/_mock/requests").json()) - before) / args.runs
+        print(f"  {label:<28} {statistics.median(times):6.3f} s, {sent:.0f} requests")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,236 @@
+# End to end benchmark of easy_run.main() against the local mock server, broken
+# down by phase of the sync.
+#
+#   python benchmarks/bench_sync.py [--scenario cold|noop|semester|filtered] [--latency 0.02]
+#                                   [--todoist-limit 450] [--todoist-window 900]
+#                                   [--recording FILE] [--no-memory]
+#
+# Scenarios:
+#   cold      first run of a fresh install: no state store, no tasks in Todoist
+#   noop      a run right after the cold one and one more, nothing changed (the
+#             cold run downloads every assignment, the runs after it only those
+#             not yet past due, so the extra run caches the pages noop requests)
+#   semester  a cold run over 20 courses with 3000 assignments
+#   filtered  a later run over the semester once its statistics are counted, with
+#             no Canvas responses cached, so it downloads only the assignments
+#             not yet past due
+# Todoist starts without projects, so the first run of each scenario creates a
+# project for every course, all in one request. With
+# --recording the courses and assignments come from a file made by
+# record_canvas.py instead of being generated.
+#
+# For every phase it reports wall time, the requests sent to Canvas and Todoist
+# and how far traced memory peaked above its level when the phase started. The
+# mock server runs in a separate process so it is not part of the measurements;
+# tracing memory slows the run down, pass --no-memory for more accurate timings.
+import argparse
+import contextlib
+import io
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import easy_run  # noqa: E402
+from mock_server import MockState, canvas_assignment, start_mock_process  # noqa: E402
+
+# Functions sync() calls in order; the Canvas download streams into the
+# transfer, so it is timed as part of it
+PHASES = [
+    ("start_account", "setup"),
+    ("sync_todoist_state", "todoist sync"),
+    ("load_todoist_projects", "load projects"),
+    ("load_todoist_tasks", "load + index tasks"),
+    ("create_todoist_projects", "create projects"),
+    ("transfer_assignments_to_todoist", "canvas + transfer"),
+    ("canvas_assignment_stats", "stats"),
+]
+
+
+# A term of assignments per course: a fifth already past due and submitted, a
+# few without a due date, the rest due over the coming weeks
+def make_semester(course_count, per_course):
+    now = datetime.now(timezone.utc).replace(minute=59, second=0, microsecond=0)
+    courses = [{"id": n, "name": f"Course {n}"} for n in range(1, course_count + 1)]
+    assignments = {}
+    for course in courses:
+        items = []
+        for n in range(per_course):
+            due = now + timedelta(days=(n * 110 // per_course) - 22, hours=n % 3)
+            item = canvas_assignment(
+                course["id"], course["id"] * 10000 + n, due_at=due.strftime("%Y-%m-%dT%H:%M:%SZ")
+            )
+            if due < now:
+                item["submission"]["workflow_state"] = "graded"
+                item["submission"]["graded_at"] = due.strftime("%Y-%m-%dT%H:%M:%SZ")
+                item["graded_submissions_exist"] = True
+            if n % 25 == 0:
+                item["due_at"] = None
+            items.append(item)
+        assignments[course["id"]] = items
+    return courses, assignments
+
+
+class PhaseRecorder:
+    def __init__(self, trace_memory):
+        self.mock_url = None
+        self.trace_memory = trace_memory
+        self.rows = []
+
+    def requests(self):
+        return requests.get(f"{self.mock_url}/_mock/requests").json()
+
+    # Replaces the phase functions in easy_run with timed wrappers
+    def install(self):
+        for name, label in PHASES:
+            setattr(easy_run, name, self.wrap(getattr(easy_run, name), label))
+
+    def wrap(self, fn, label):
+        def timed(*args, **kwargs):
+            before = len(self.requests())
+            baseline = 0
+            if self.trace_memory:
+                tracemalloc.reset_peak()
+                baseline = tracemalloc.get_traced_memory()[0]
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                peak = tracemalloc.get_traced_memory()[1] - baseline if self.trace_memory else 0
+                sent = self.requests()[before:]
+                self.rows.append((label, elapsed, sent, peak))
+
+        return timed
+
+
+# A mock server with its own state store directory. cold and noop share one,
+# the noop run reusing what the cold run left behind
+class Environment:
+    def __init__(self, state, loader="rest"):
+        self.state = state
+        self.process, self.url = start_mock_process(state)
+        self.workdir = tempfile.mkdtemp()
+        self.runs = 0
+        with open(os.path.join(self.workdir, "config.json"), "w") as config_file:
+            json.dump(
+                {
+                    "todoist_api_key": "mock",
+                    "canvas_api_key": "mock",
+                    "canvas_api_heading": self.url,
+                    "todoist_task_labels": [],
+                    "sync_null_assignments": False,
+                    "sync_locked_assignments": False,
+                    "sync_no_due_date_assignments": True,
+                    "courses": [str(course["id"]) for course in state.courses],
+                    "canvas_loader": loader,
+                },
+                config_file,
+            )
+
+    # Runs easy_run.main() against this environment, returning the wall time
+    # and what it printed
+    def run_main(self, recorder):
+        easy_run.todoist_sync_url = f"{self.url}/todoist/api/v1/sync"
+        recorder.mock_url = self.url
+        recorder.rows.clear()
+        cwd = os.getcwd()
+        os.chdir(self.workdir)
+        sys.argv = ["easy_run.py"]
+        output = io.StringIO()
+        start = time.perf_counter()
+        try:
+            with contextlib.redirect_stdout(output):
+                easy_run.main()
+        finally:
+            os.chdir(cwd)
+        self.runs += 1
+        return time.perf_counter() - start, output.getvalue()
+
+    def clear_canvas_cache(self):
+        with sqlite3.connect(os.path.join(self.workdir, "state.db")) as state_db:
+            state_db.execute("DELETE FROM http_cache")
+
+
+def report(title, total, rows, output):
+    print(f"\n{title}: {total:.2f} s")
+    print(
+        f"  {'phase':<18} {'wall s':>8} {'canvas':>7} {'todoist':>8} {'KB':>7} {'statuses':<24} {'peak +MB':>8}"
+    )
+    for label, elapsed, sent, peak in rows:
+        canvas = sum(1 for _, path, _, _ in sent if path.startswith("/api/"))
+        todoist = sum(1 for _, path, _, _ in sent if path.startswith("/todoist/"))
+        received = sum(size for _, _, _, size in sent) / 1000
+        statuses = ", ".join(f"{k}:{v}" for k, v in sorted(Counter(s for _, _, s, _ in sent).items()))
+        print(
+            f"  {label:<18} {elapsed:8.3f} {canvas:7d} {todoist:8d} {received:7.0f} {statuses:<24} {peak / 1e6:8.2f}"
+        )
+    for line in output.splitlines():
+        if line.startswith(("Added to Todoist", "Already Synced", "Todoist Sync Requests")):
+            print(f"  {line}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scenario", choices=["cold", "noop", "semester", "filtered"], action="append")
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds added to every response")
+    parser.add_argument("--todoist-limit", type=int, default=450, help="Todoist requests per window before 429s")
+    parser.add_argument("--todoist-window", type=float, default=15 * 60, help="seconds")
+    parser.add_argument("--recording", help="replay a file made by record_canvas.py")
+    parser.add_argument("--loader", choices=["rest", "graphql"], default="rest", help="canvas_loader to configure")
+    parser.add_argument("--no-memory", action="store_true")
+    args = parser.parse_args()
+    scenarios = args.scenario or ["cold", "noop", "semester", "filtered"]
+
+    trace_memory = not args.no_memory
+    if trace_memory:
+        tracemalloc.start()
+    recorder = PhaseRecorder(trace_memory)
+    recorder.install()
+    options = dict(
+        latency=args.latency,
+        todoist_limit=args.todoist_limit,
+        todoist_window=args.todoist_window,
+    )
+    environments = {}
+    for scenario in scenarios:
+        size = "semester" if scenario in ("semester", "filtered") else "small"
+        if size not in environments:
+            if args.recording:
+                state = MockState.from_recording(args.recording, **options)
+            elif size == "semester":
+                state = MockState(*make_semester(20, 150), **options)
+            else:
+                state = MockState(*make_semester(6, 50), **options)
+            environments[size] = Environment(state, args.loader)
+        environment = environments[size]
+        # A filtered run needs the statistics a first run counts. A no-op run
+        # also needs a run after that, which caches the pages of assignments
+        # not yet past due that the no-op run revalidates
+        warm_up_runs = {"noop": 2, "filtered": 1}.get(scenario, 0)
+        while environment.runs < warm_up_runs:
+            environment.run_main(recorder)
+        if scenario == "filtered":
+            environment.clear_canvas_cache()
+        total, output = environment.run_main(recorder)
+        state = environment.state
+        assignment_count = sum(len(items) for items in state.assignments.values())
+        report(
+            f"{scenario} ({len(state.courses)} courses, {assignment_count} assignments)",
+            total,
+            recorder.rows,
+            output,
+        )
+
+
+if __name__ == "__main__":
+    main()
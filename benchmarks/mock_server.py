@@ -0,0 +1,518 @@
+# Local stand-in for the Canvas and Todoist APIs used by the benchmarks.
+#
+# Canvas endpoints (/api/v1/...) emulate the leaky bucket: each request costs
+# X-Request-Cost units, the bucket drains at canvas_leak_rate units per second,
+# and requests that would overflow it get 403 "Rate Limit Exceeded". Responses
+# carry an ETag and honour If-None-Match with an empty 304. Assignments, listed
+# or fetched one at a time, drop the fields named in exclude_response_fields[],
+# and listings honour the past, future and undated values of bucket.
+# /api/v1/planner/items lists the dated assignments of the courses in
+# context_codes[] from start_date on, paginated like the assignment lists.
+# Todoist endpoints (/todoist/...) allow todoist_limit requests per
+# todoist_window seconds and answer 429 with Retry-After beyond that.
+# /todoist/api/v1/sync applies item and project commands to an in-memory store
+# and answers read requests incrementally from sync_token; every
+# todoist_fail_every-th command fails once with a retryable 500, and a command
+# uuid seen before is answered "ok" without being applied again. Temp ids of
+# objects created earlier in a request are resolved in later commands, and
+# tasks added to a project that does not exist are rejected.
+# /api/graphql answers the course assignment queries of the GraphQL loader.
+# Canvas data is either generated (canvas_assignment) or replayed from a
+# recording made with record_canvas.py (MockState.from_recording).
+import hashlib
+import json
+import multiprocessing
+import re
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlparse
+
+
+# A Canvas assignment as the API returns it with include[]=submission, including
+# the description HTML and rubric that make real payloads heavy
+def canvas_assignment(course_id, assignment_id, due_at=None, base_url="https://canvas.example.edu"):
+    return {
+        "id": assignment_id,
+        "course_id": course_id,
+        "name": f"Assignment {assignment_id}",
+        "description": "<p>" + "Read the chapter and answer the questions. " * 40 + "</p>",
+        "html_url": f"{base_url}/courses/{course_id}/assignments/{assignment_id}",
+        "due_at": due_at,
+        "lock_at": None,
+        "unlock_at": None,
+        "created_at": "2026-01-05T17:00:00Z",
+        "updated_at": "2026-01-06T17:00:00Z",
+        "points_possible": 10.0,
+        "grading_type": "points",
+        "submission_types": ["online_upload"],
+        "allowed_extensions": ["pdf", "docx"],
+        "has_submitted_submissions": False,
+        "graded_submissions_exist": False,
+        "locked_for_user": False,
+        "lock_explanation": None,
+        "published": True,
+        "muted": False,
+        "position": 1,
+        "assignment_group_id": 100 + course_id,
+        "rubric": [
+            {
+                "id": f"r{n}",
+                "points": 5.0,
+                "description": f"Criterion {n}",
+                "long_description": "Meets the expectations for this criterion. " * 5,
+                "ratings": [
+                    {"id": f"r{n}_{k}", "points": float(k), "description": f"Rating {k}"}
+                    for k in range(3)
+                ],
+            }
+            for n in range(2)
+        ],
+        "submission": {
+            "id": assignment_id * 10,
+            "assignment_id": assignment_id,
+            "user_id": 1,
+            "workflow_state": "unsubmitted",
+            "submitted_at": None,
+            "graded_at": None,
+            "grade": None,
+            "score": None,
+            "attempt": None,
+            "late": False,
+            "missing": False,
+        },
+    }
+
+
+# Strips everything identifying from a recorded Canvas assignment: names, the
+# Canvas host, descriptions and rubrics. Ids, dates and states are kept since
+# they drive the sync
+def anonymize_assignment(item, base_url="https://canvas.example.edu"):
+    item = {k: v for k, v in item.items() if k not in ("description", "rubric")}
+    item["name"] = f"Assignment {item['id']}"
+    item["html_url"] = f"{base_url}/courses/{item['course_id']}/assignments/{item['id']}"
+    item["lock_explanation"] = None
+    if item.get("submission"):
+        item["submission"] = {
+            key: item["submission"].get(key)
+            for key in ("workflow_state", "graded_at", "submitted_at", "late", "missing")
+        }
+    return item
+
+
+# The GraphQL shape of a REST assignment. Timestamps are given with a local
+# offset, as Canvas may send them, rather than in UTC
+def graphql_assignment(item):
+    def local(value):
+        if value is None:
+            return None
+        utc = datetime.strptime(value, "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=timezone.utc)
+        return utc.astimezone(timezone(timedelta(hours=-6))).isoformat()
+
+    submission = item.get("submission") or {}
+    return {
+        "_id": str(item["id"]),
+        "name": item["name"],
+        "htmlUrl": item["html_url"],
+        "dueAt": local(item.get("due_at")),
+        "unlockAt": local(item.get("unlock_at")),
+        "updatedAt": local(item.get("updated_at")),
+        "submissionTypes": item.get("submission_types"),
+        "gradedSubmissionsExist": item.get("graded_submissions_exist", False),
+        "lockInfo": {"isLocked": item.get("locked_for_user", False)},
+        "submissionsConnection": {
+            "nodes": [
+                {
+                    "state": submission.get("workflow_state", "unsubmitted"),
+                    "gradedAt": local(submission.get("graded_at")),
+                }
+            ]
+        },
+    }
+
+
+# Whether an assignment falls in a Canvas bucket; future is everything not yet
+# past due, undated assignments included
+def in_bucket(item, bucket):
+    now = datetime.now(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+    past = item["due_at"] is not None and item["due_at"] < now
+    if bucket == "past":
+        return past
+    if bucket == "undated":
+        return item["due_at"] is None
+    return not past
+
+
+class MockState:
+    def __init__(
+        self,
+        courses=None,
+        assignments=None,
+        page_size=100,
+        latency=0.0,
+        canvas_capacity=700,
+        canvas_leak_rate=10,
+        canvas_cost=1,
+        todoist_limit=450,
+        todoist_window=15 * 60,
+        todoist_fail_every=0,
+    ):
+        self.courses = courses or []
+        self.assignments = assignments or {}  # course id -> list of assignments
+        self.page_size = page_size
+        self.latency = latency
+        self.canvas_capacity = canvas_capacity
+        self.canvas_leak_rate = canvas_leak_rate
+        self.canvas_cost = canvas_cost
+        self.canvas_used = 0.0
+        self.canvas_updated = time.monotonic()
+        self.todoist_limit = todoist_limit
+        self.todoist_window = todoist_window
+        self.todoist_hits = []
+        self.todoist_fail_every = todoist_fail_every
+        self.todoist_commands = 0
+        self.todoist_failed = set()
+        self.todoist_applied = {}  # command uuid -> id it created, to apply each uuid once
+        self.tasks = {}  # task id -> task dict
+        self.projects = {}  # project id -> project dict
+        self.version = 0  # bumped on every change, doubles as the sync token
+        self.changed = {}  # task or project id -> version of its last change
+        self.requests = []  # (method, path, status, response body bytes)
+        self.lock = threading.Lock()
+
+    # Builds a mock serving the courses and assignments of a recording file
+    @classmethod
+    def from_recording(cls, path, **options):
+        with open(path) as f:
+            recording = json.load(f)
+        assignments = {
+            int(course_id): items for course_id, items in recording["assignments"].items()
+        }
+        return cls(courses=recording["courses"], assignments=assignments, **options)
+
+    # Adds a Todoist project for every course, as for a user who already ran the sync
+    def add_course_projects(self):
+        for course in self.courses:
+            project_id = f"p{course['id']}"
+            self.version += 1
+            self.projects[project_id] = {"id": project_id, "name": course["name"]}
+            self.changed[project_id] = self.version
+
+    def charge_canvas(self):
+        with self.lock:
+            now = time.monotonic()
+            leaked = (now - self.canvas_updated) * self.canvas_leak_rate
+            self.canvas_used = max(0.0, self.canvas_used - leaked)
+            self.canvas_updated = now
+            if self.canvas_used + self.canvas_cost > self.canvas_capacity:
+                return None
+            self.canvas_used += self.canvas_cost
+            return self.canvas_capacity - self.canvas_used
+
+    def charge_todoist(self):
+        with self.lock:
+            now = time.monotonic()
+            self.todoist_hits = [t for t in self.todoist_hits if now - t < self.todoist_window]
+            if len(self.todoist_hits) >= self.todoist_limit:
+                return self.todoist_window - (now - self.todoist_hits[0])
+            self.todoist_hits.append(now)
+            return None
+
+    def record(self, method, path, status, size=0):
+        with self.lock:
+            self.requests.append((method, path, status, size))
+
+    def status_counts(self):
+        counts = {}
+        for _, _, status, _ in self.requests:
+            counts[status] = counts.get(status, 0) + 1
+        return counts
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    @property
+    def state(self):
+        return self.server.state
+
+    def send_json(self, status, body, headers=None, etag=False):
+        payload = json.dumps(body).encode()
+        if etag:
+            tag = '"%s"' % hashlib.md5(payload).hexdigest()
+            headers = dict(headers or {}, ETag=tag)
+            if self.headers.get("If-None-Match") == tag:
+                status, payload = 304, b""
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(payload)
+        self.state.record(self.command, urlparse(self.path).path, status, len(payload))
+
+    def do_GET(self):
+        self.handle_request()
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        self.body = self.rfile.read(length) if length else b""
+        self.handle_request()
+
+    def handle_request(self):
+        if self.state.latency:
+            time.sleep(self.state.latency)
+        url = urlparse(self.path)
+        if url.path == "/_mock/requests":
+            # Request log for harnesses running the server in another process
+            payload = json.dumps(self.state.requests).encode()
+            self.send_response(200)
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+            return
+        if url.path.startswith("/todoist/"):
+            return self.handle_todoist(url)
+        if url.path.startswith("/api/"):
+            return self.handle_canvas(url)
+        self.send_json(404, {"error": "not found"})
+
+    def handle_canvas(self, url):
+        remaining = self.state.charge_canvas()
+        if remaining is None:
+            payload = b"403 Forbidden (Rate Limit Exceeded)"
+            self.send_response(403)
+            self.send_header("Content-Length", str(len(payload)))
+            self.send_header("X-Rate-Limit-Remaining", "0.0")
+            self.end_headers()
+            self.wfile.write(payload)
+            self.state.record(self.command, url.path, 403, len(payload))
+            return
+        headers = {
+            "X-Rate-Limit-Remaining": f"{remaining:.1f}",
+            "X-Request-Cost": f"{self.state.canvas_cost:.1f}",
+        }
+        if url.path == "/api/graphql":
+            return self.handle_graphql(headers)
+        if url.path == "/api/v1/courses":
+            return self.send_json(200, self.state.courses, headers, etag=True)
+        if url.path == "/api/v1/planner/items":
+            return self.send_planner_items(url, headers)
+        match = re.fullmatch(r"/api/v1/courses/(\d+)/assignments/(\d+)", url.path)
+        if match is not None:
+            return self.send_assignment(int(match.group(1)), int(match.group(2)), url, headers)
+        match = re.fullmatch(r"/api/v1/courses/(\d+)/assignments", url.path)
+        if match is None:
+            return self.send_json(404, {"errors": [{"message": "not found"}]}, headers)
+        items = self.state.assignments.get(int(match.group(1)), [])
+        query = parse_qs(url.query)
+        bucket = query.get("bucket", [None])[0]
+        if bucket is not None:
+            items = [item for item in items if in_bucket(item, bucket)]
+        page = int(query.pop("page", ["1"])[0])
+        start = (page - 1) * self.state.page_size
+        if start + self.state.page_size < len(items):
+            # Like Canvas, the next link keeps the original query parameters
+            host = self.headers.get("Host")
+            next_query = urlencode(dict(query, page=[page + 1]), doseq=True)
+            headers["Link"] = (
+                f'<http://{host}{url.path}?{next_query}>; rel="next"'
+            )
+        items = items[start : start + self.state.page_size]
+        excluded = query.get("exclude_response_fields[]", [])
+        if excluded:
+            items = [
+                {key: value for key, value in item.items() if key not in excluded}
+                for item in items
+            ]
+        self.send_json(200, items, headers, etag=True)
+
+    def send_planner_items(self, url, headers):
+        query = parse_qs(url.query)
+        start_date = query.get("start_date", [""])[0]
+        items = [
+            {
+                "plannable_id": item["id"],
+                "plannable_type": "assignment",
+                "plannable_date": item["due_at"],
+                "context_type": "Course",
+                "course_id": item["course_id"],
+                "plannable": {
+                    "id": item["id"],
+                    "title": item["name"],
+                    "due_at": item["due_at"],
+                    "updated_at": item.get("updated_at"),
+                },
+                "submissions": {
+                    "submitted": (item.get("submission") or {}).get("workflow_state")
+                    not in (None, "unsubmitted"),
+                },
+            }
+            for code in query.get("context_codes[]", [])
+            for item in self.state.assignments.get(int(code.removeprefix("course_")), [])
+            if item["due_at"] is not None and item["due_at"] >= start_date
+        ]
+        items.sort(key=lambda item: (item["plannable_date"], item["plannable_id"]))
+        page = int(query.pop("page", ["1"])[0])
+        start = (page - 1) * self.state.page_size
+        if start + self.state.page_size < len(items):
+            host = self.headers.get("Host")
+            next_query = urlencode(dict(query, page=[page + 1]), doseq=True)
+            headers["Link"] = f'<http://{host}{url.path}?{next_query}>; rel="next"'
+        self.send_json(200, items[start : start + self.state.page_size], headers, etag=True)
+
+    def send_assignment(self, course_id, assignment_id, url, headers):
+        for item in self.state.assignments.get(course_id, []):
+            if item["id"] == assignment_id:
+                excluded = parse_qs(url.query).get("exclude_response_fields[]", [])
+                item = {key: value for key, value in item.items() if key not in excluded}
+                return self.send_json(200, item, headers, etag=True)
+        self.send_json(404, {"errors": [{"message": "not found"}]}, headers)
+
+    # Answers the course/assignmentsConnection queries of the GraphQL loader. Only
+    # that query shape is understood; cursors are offsets into the course's list
+    def handle_graphql(self, headers):
+        request = json.loads(self.body)
+        variables = request.get("variables") or {}
+        data = {}
+        for alias, course_id, first in re.findall(
+            r'(\w+): course\(id: "(\d+)"\) \{ assignmentsConnection\(first: (\d+)',
+            request["query"],
+        ):
+            if int(course_id) not in self.state.assignments:
+                data[alias] = None
+                continue
+            items = self.state.assignments[int(course_id)]
+            start = int(variables.get(alias) or 0)
+            end = start + int(first)
+            data[alias] = {
+                "assignmentsConnection": {
+                    "nodes": [graphql_assignment(item) for item in items[start:end]],
+                    "pageInfo": {"hasNextPage": end < len(items), "endCursor": str(end)},
+                }
+            }
+        self.send_json(200, {"data": data}, headers)
+
+    def handle_todoist(self, url):
+        retry = self.state.charge_todoist()
+        if retry is not None:
+            return self.send_json(
+                429, {"error": "Too Many Requests"}, {"Retry-After": str(int(retry) + 1)}
+            )
+        if url.path == "/todoist/api/v1/sync":
+            form = parse_qs(self.body.decode())
+            commands = json.loads(form.get("commands", ["[]"])[0])
+            body = self.apply_commands(commands)
+            if "sync_token" in form:
+                body.update(self.read_changes(form["sync_token"][0]))
+            return self.send_json(200, body)
+        self.send_json(200, {"ok": True})
+
+    def read_changes(self, token):
+        state = self.state
+        with state.lock:
+            since = 0 if token == "*" else int(token)
+            changed = {key for key, version in state.changed.items() if version > since}
+            return {
+                "full_sync": token == "*",
+                "sync_token": str(state.version),
+                "items": [task for key, task in state.tasks.items() if key in changed],
+                "projects": [p for key, p in state.projects.items() if key in changed],
+            }
+
+    def apply_commands(self, commands):
+        state = self.state
+        sync_status = {}
+        temp_id_mapping = {}
+        with state.lock:
+            for command in commands:
+                if command["uuid"] in state.todoist_applied:
+                    # Like Todoist, a command sent again is answered without applying it twice
+                    sync_status[command["uuid"]] = "ok"
+                    if command.get("temp_id"):
+                        temp_id_mapping[command["temp_id"]] = state.todoist_applied[command["uuid"]]
+                    continue
+                state.todoist_commands += 1
+                if (
+                    state.todoist_fail_every
+                    and state.todoist_commands % state.todoist_fail_every == 0
+                    and command["uuid"] not in state.todoist_failed
+                ):
+                    state.todoist_failed.add(command["uuid"])
+                    sync_status[command["uuid"]] = {"error": "Service unavailable", "http_code": 500}
+                    continue
+                # Like Todoist, objects created earlier in the request can be
+                # referred to by their temp id
+                args = {
+                    key: temp_id_mapping.get(value, value) if key in temp_id_keys else value
+                    for key, value in command["args"].items()
+                }
+                if command["type"] == "item_add":
+                    if args.get("project_id") not in state.projects:
+                        sync_status[command["uuid"]] = {"error": "Project not found", "http_code": 404}
+                        continue
+                    task_id = uuid.uuid4().hex[:16]
+                    state.tasks[task_id] = dict(args, id=task_id)
+                    state.version += 1
+                    state.changed[task_id] = state.version
+                    temp_id_mapping[command.get("temp_id")] = task_id
+                elif command["type"] == "project_add":
+                    project_id = uuid.uuid4().hex[:16]
+                    state.projects[project_id] = dict(args, id=project_id)
+                    state.version += 1
+                    state.changed[project_id] = state.version
+                    temp_id_mapping[command.get("temp_id")] = project_id
+                elif command["type"] == "item_close":
+                    if args["id"] not in state.tasks:
+                        sync_status[command["uuid"]] = {"error": "Task not found", "http_code": 404}
+                        continue
+                    state.tasks[args["id"]]["checked"] = True
+                    state.version += 1
+                    state.changed[args["id"]] = state.version
+                elif command["type"] == "item_update":
+                    if args["id"] not in state.tasks:
+                        sync_status[command["uuid"]] = {"error": "Task not found", "http_code": 404}
+                        continue
+                    state.tasks[args["id"]].update(args)
+                    state.version += 1
+                    state.changed[args["id"]] = state.version
+                sync_status[command["uuid"]] = "ok"
+                state.todoist_applied[command["uuid"]] = temp_id_mapping.get(command.get("temp_id"))
+        return {"sync_status": sync_status, "temp_id_mapping": temp_id_mapping}
+
+
+# Command arguments that may hold the temp id of an object created earlier
+temp_id_keys = frozenset(["id", "project_id", "parent_id", "section_id"])
+
+
+# Starts the mock server on a free local port in a background thread
+def start_mock_server(state):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), MockHandler)
+    server.daemon_threads = True
+    server.state = state
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    host, port = server.server_address
+    return server, f"http://{host}:{port}"
+
+
+# Runs the mock server in a forked child process, so that its allocations and
+# CPU time stay out of measurements taken in the calling process. The request
+# log is then read over HTTP from /_mock/requests
+def start_mock_process(state):
+    context = multiprocessing.get_context("fork")
+    urls = context.Queue()
+
+    def serve():
+        server, url = start_mock_server(state)
+        urls.put(url)
+        threading.Event().wait()
+
+    process = context.Process(target=serve, daemon=True)
+    process.start()
+    return process, urls.get()
@@ -0,0 +1,54 @@
+# Records the courses and assignments of the account in config.json into an
+# anonymized file the mock server can replay:
+#
+#   python benchmarks/record_canvas.py recording.json
+#   python benchmarks/bench_sync.py --recording recording.json
+#
+# Only the courses selected in config.json are recorded. Names, the Canvas host,
+# descriptions and rubrics are replaced or dropped; ids, dates and submission
+# states are kept.
+import json
+import os
+import sys
+
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import easy_run  # noqa: E402
+from mock_server import anonymize_assignment  # noqa: E402
+
+
+def main():
+    if len(sys.argv) != 2:
+        exit("usage: python benchmarks/record_canvas.py OUTPUT")
+    with open("config.json") as config_file:
+        config = json.load(config_file)
+    session = requests.Session()
+    session.headers["Authorization"] = "Bearer " + config["canvas_api_key"]
+    heading = config["canvas_api_heading"]
+
+    courses = []
+    assignments = {}
+    for n, course_id in enumerate(config["courses"], 1):
+        course_id = int(course_id)
+        courses.append({"id": course_id, "name": f"Course {n}"})
+        items = []
+        response = session.get(
+            f"{heading}/api/v1/courses/{course_id}/assignments", params=easy_run.param
+        )
+        response.raise_for_status()
+        items.extend(response.json())
+        while "next" in response.links:
+            response = session.get(response.links["next"]["url"])
+            response.raise_for_status()
+            items.extend(response.json())
+        assignments[course_id] = [anonymize_assignment(item) for item in items]
+        print(f"Recorded {len(items)} assignments of course {n}")
+
+    with open(sys.argv[1], "w") as output:
+        json.dump({"courses": courses, "assignments": assignments}, output)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,48 +1,789 @@
 # -*- coding: utf-8 -*-
 # Import Libraries
-from typing import List
-import requests
+from typing import Optional
+from dataclasses import dataclass
+from collections import namedtuple, Counter
+from functools import lru_cache
+from contextlib import contextmanager
+from urllib.parse import urlparse, urlencode
 import re
 import json
-from todoist_api_python.api import TodoistAPI
-from todoist_api_python.models import Task as tTask
-from requests.auth import HTTPDigestAuth
+import sqlite3
+import argparse
+import signal
+import os
+import glob
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone, timedelta
 from zoneinfo import ZoneInfo
 import time
-from random import randint
+import threading
+import queue
+import uuid
+import hmac
+import hashlib
+import base64
+from random import uniform
 
-# Load configuration files and creates a list of course_ids
-config = {}
-header = {}
+# requests is imported by initialize_api and the functions that need it, so a
+# --quick run that finds nothing to do (and talks HTTP through urllib) does not
+# pay for its import
+
+# Settings shared by every account
 param = {"per_page": "100", "include": "submission", "enrollment_state": "active"}
-course_ids = []
-assignments = []
-todoist_tasks: List[tTask] = []
-courses_id_name_dict = {}
-todoist_project_dict = {}
-throttle_number = 50  # Number of requests to make before sleeping for delay seconds
-sleep_delay_max = 2500  # Maximum number of milliseconds to sleep for
-max_added = 250  # Maximum number of assignments to add to Todoist at once. Todoist API limit is 450 requests per 15 minutes and you can quickly hit this if adding a massive number of assignments.
-limit_reached = False  # Global var used to terminate early if limit is reached or API returns an error.
+# Assignment bodies are large because of the description HTML and rubric, which the sync never reads
+assignment_param = dict(
+    param, **{"exclude_response_fields[]": ["description", "rubric"]}
+)
+# Only the assignments not yet past due, which Canvas works out with the user's own
+# due dates; its future bucket includes the ones without a due date
+candidate_param = dict(assignment_param, bucket="future")
+stats_max_age_hours = 24  # Default hours between downloads of every assignment to recount the statistics, overridable with "canvas_stats_max_age_hours" in config.json
+canvas_max_workers = 4  # Default number of courses to load concurrently, overridable with "canvas_max_workers" in config.json
+course_page_buffer = 4  # Pages of a course downloaded ahead of the matcher before its download waits
+# Fields of a Todoist item the sync reads, as stored in the local state store
+TodoistTask = namedtuple("TodoistTask", ["id", "project_id", "content", "description"])
+max_retries = 5  # Number of times a throttled or failed request is retried before giving up
+request_timeout = 30  # Seconds to wait for a connection or a response before the attempt counts as failed
+canvas_preflight_cost = 50  # Canvas charges this many units up front for every request
+todoist_burst = 50  # Todoist requests allowed back to back before the 450 per 15 minutes pacing kicks in
+todoist_sync_url = "https://api.todoist.com/api/v1/sync"
+sync_batch_size = 100  # Todoist accepts at most 100 commands per Sync API request
+cache_max_mb = 50  # Default size of the Canvas response cache, overridable with "canvas_cache_max_mb" in config.json
+batch_workers = 4  # Default number of accounts synced at the same time in batch mode
+stop_event = threading.Event()  # Set by SIGTERM/SIGINT to end daemon mode after the current pass
+mountain_time = ZoneInfo("America/Phoenix")  # Time zone due dates are shown in
+latency_buckets = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)  # Upper bounds in seconds of the HTTP latency histograms
+metrics_log_path = None  # Set by --metrics-log: file each sync appends its metrics to as a JSON line, "-" for stdout
+prometheus_path = None  # Set by --prometheus: Prometheus text file rewritten after every sync
+metrics_lock = threading.Lock()  # Serializes metrics writes from concurrent accounts
+listen_max_wait = 6  # A steady stream of events is synced at least every this many debounce periods
+listen_course_threshold = 10  # Changed assignments in one course above which its assignment list is loaded instead
+
+
+# Raised when an account cannot be synced, e.g. a rejected API key. Ends a
+# single-account run and is logged per account in batch and daemon mode
+class SyncError(Exception):
+    pass
+
+
+# Everything a sync needs for one Canvas/Todoist user: configuration, pooled
+# sessions, rate limit budgets, the state store and the data loaded in a pass.
+# Several accounts can sync side by side in one process without sharing any of it
+class Account:
+    def __init__(self, config_path="config.json", name=None, interactive=True, use_cache=True):
+        self.config_path = config_path
+        self.state_path = state_path_for(config_path)
+        self.name = name  # Prefix for log lines, None when syncing a single account
+        self.interactive = interactive  # Whether setup questions may be asked on stdin
+        self.use_cache = use_cache  # Cache Canvas responses and revalidate them with ETag/Last-Modified
+        self.config = {}
+        self.header = {}
+        self.todoist_header = {}
+        self.course_ids = []
+        self.courses_id_name_dict = {}
+        self.canvas_session = None  # Pooled keep-alive session for Canvas, made by initialize_api
+        self.todoist_session = None  # Pooled session for Todoist Sync API requests
+        # Canvas leaks roughly 10 units per second out of a 700 unit bucket
+        self.canvas_limiter = RateLimiter("Canvas", rate=10, burst=700, log=self.log)
+        # Todoist allows 450 requests per 15 minutes, paced evenly after a short burst
+        self.todoist_limiter = RateLimiter(
+            "Todoist", rate=450 / (15 * 60), burst=todoist_burst, log=self.log
+        )
+        self.state_db = None
+        self.state_lock = threading.Lock()  # Serializes state store access from concurrent course loads
+        self.started = False
+        self.planning = False  # Collect Todoist writes into a plan instead of sending them
+        self.reset()
+
+    # Empties everything a sync pass fills in, so repeated passes in daemon mode do
+    # not keep growing
+    def reset(self):
+        self.todoist_task_count = 0  # Tasks of the course projects loaded by load_todoist_tasks
+        self.todoist_changed_task_ids = set()  # Tasks created or edited in Todoist since the last run
+        self.todoist_task_index = {}  # (project_id, task content) -> task, built as load_todoist_tasks streams
+        self.todoist_task_url_index = {}  # Canvas assignment id (from the task's html_url) -> task
+        self.todoist_project_dict = {}
+        self.course_project_ids = {}  # Canvas course id -> id of the Todoist project its tasks go to
+        self.todoist_queue = (
+            PlannedCommandQueue(self) if self.planning else TodoistCommandQueue(self)
+        )
+        self.planner_fingerprint = None  # Set by nothing_changed, stored once the sync finishes
+        self.next_unlock = None  # Earliest time an assignment held back as locked gets close enough to sync
+        self.limit_reached = False  # Set when Todoist did not accept every change
+        self.canvas_incomplete = False  # Set when the download skipped an assignment or course
+        self.metrics = Metrics(self)
+
+    def log(self, message):
+        if self.name is None:
+            print(message)
+        else:
+            # One write per line so lines from concurrent accounts do not interleave
+            print(f"[{self.name}] {message}\n", end="")
+
+
+# The state store lives next to the config file: config.json keeps state.db,
+# any other alice.json gets alice.state.db
+def state_path_for(config_path):
+    directory, filename = os.path.split(config_path)
+    if filename == "config.json":
+        return os.path.join(directory, "state.db")
+    return os.path.join(directory, os.path.splitext(filename)[0] + ".state.db")
 
 
 def main():
-    print(f"  {'#'*52}")
-    print(" #     Canvas-Assignments-Transfer-For-Todoist     #")
-    print(f"{'#'*52}\n")
-    initialize_api()
-    print("API INITIALIZED")
-    select_courses()
-    print(f"Selected {len(course_ids)} courses")
-    print("Syncing Canvas Assignments...")
-    load_todoist_projects()
-    load_assignments()
-    load_todoist_tasks()
-    create_todoist_projects()
-    transfer_assignments_to_todoist()
-    canvas_assignment_stats()
-    print("Done!")
+    global metrics_log_path, prometheus_path
+    args = parse_args()
+    metrics_log_path = args.metrics_log
+    prometheus_path = args.prometheus
+    if not args.quick:
+        print(f"  {'#'*52}")
+        print(" #     Canvas-Assignments-Transfer-For-Todoist     #")
+        print(f"{'#'*52}\n")
+    if args.batch:
+        accounts = [
+            Account(
+                path,
+                name=os.path.splitext(os.path.basename(path))[0],
+                interactive=False,
+                use_cache=not args.no_cache,
+            )
+            for path in batch_config_paths(args.batch)
+        ]
+        print(f"Loaded {len(accounts)} account configs")
+    else:
+        accounts = [Account(use_cache=not args.no_cache)]
+    if args.command == "plan":
+        accounts[0].planning = True
+        if not sync_accounts(accounts, args.workers):
+            exit(1)
+        save_plan(accounts[0], args.plan_file)
+    elif args.command == "apply":
+        if not apply_plan(accounts[0], args.plan_file, args.rate):
+            exit(1)
+    elif args.command == "listen":
+        run_listener(accounts[0], args.host, args.port, args.debounce, args.interval)
+    elif args.daemon:
+        run_daemon(accounts, args.workers, args.interval, args.jitter, args.full_every)
+    else:
+        # With --batch the other accounts were still synced; the exit status
+        # tells cron that one of them failed
+        if not sync_accounts(accounts, args.workers, full=not args.quick):
+            exit(1)
+    if not args.quick:
+        print("Done!")
+
+
+# Loads the config, state store and course selection of an account on its first
+# pass, skipping what a nothing_changed check already loaded
+def start_account(account):
+    if account.canvas_session is None:
+        initialize_api(account)
+    account.log("API INITIALIZED")
+    if account.state_db is None:
+        open_state(account)
+    select_courses(account)
+    account.log(f"Selected {len(account.course_ids)} courses")
+    account.started = True
+
+
+# One full pass over Canvas and Todoist for an account. Assignments flow from the
+# Canvas download through the filter and matcher into batched Todoist writes.
+# With full=False the pass stops early if nothing_changed finds nothing to do
+def sync(account, full=True):
+    account.reset()
+    metrics = account.metrics
+    with metrics.span("total"):
+        if not full:
+            with metrics.span("probe"):
+                unchanged = nothing_changed(account)
+            if unchanged:
+                account.log("No changes in Canvas or Todoist since the last sync")
+                return
+        if not account.started:
+            with metrics.span("start"):
+                start_account(account)
+        account.log("Syncing Canvas Assignments...")
+        # Cleared until the sync finishes, so a sync that fails after saving the
+        # sync token or cached pages is not skipped by the next --quick run
+        with account.state_db:
+            state_set(account, "last_sync_complete", "0")
+        with metrics.span("todoist_state"):
+            if not account.planning:
+                replay_journal(account)
+            sync_todoist_state(account)
+            load_todoist_projects(account)
+            load_todoist_tasks(account)
+        with metrics.span("create_projects"):
+            create_todoist_projects(account)
+        everything = full_download_due(account)
+        stats = AssignmentStats()
+        seen = SeenAssignments()
+        assignments = seen.recorded(stream_assignments(account, everything))
+        if everything:
+            assignments = stats.counted(assignments)
+        # Canvas pages stream straight into the matcher, so the download is timed
+        # together with the transfer
+        with metrics.span("assignments"):
+            transfer_assignments_to_todoist(account, assignments)
+        with metrics.span("reconcile"):
+            reconcile_todoist_tasks(account, seen, complete=everything)
+        if account.todoist_queue.results and not account.planning:
+            # Takes in this sync's own changes, so the next --quick check does
+            # not mistake them for changes made in Todoist
+            with metrics.span("todoist_state"):
+                sync_todoist_state(account)
+        with account.state_db:
+            state_set(
+                account,
+                "next_unlock",
+                account.next_unlock.isoformat() if account.next_unlock else None,
+            )
+            if everything:
+                state_set(account, "assignment_stats", stats.to_json(account))
+            else:
+                stats = AssignmentStats.from_json(state_get(account, "assignment_stats"))
+            if not account.planning and not account.limit_reached:
+                state_set(account, "last_sync_complete", "1")
+                if account.planner_fingerprint is not None:
+                    state_set(account, "planner_fingerprint", account.planner_fingerprint)
+        with metrics.span("stats"):
+            canvas_assignment_stats(account, stats)
+
+
+# Whether this sync downloads every assignment, past due ones included, to recount
+# the statistics. In between only the assignments not yet past due (the only ones
+# the sync acts on) are downloaded and the stored statistics are shown. The
+# GraphQL loader has no due date filter, so it always downloads everything
+def full_download_due(account):
+    if account.config.get("canvas_loader", "rest") == "graphql":
+        return True
+    stored = state_get(account, "assignment_stats")
+    if stored is None:
+        return True
+    stats = AssignmentStats.from_json(stored)
+    return stats.courses != sorted(map(str, account.course_ids)) or stats_expired(account, stats)
+
+
+def stats_expired(account, stats):
+    max_age = timedelta(
+        hours=float(account.config.get("canvas_stats_max_age_hours", stats_max_age_hours))
+    )
+    return stats.counted_at <= datetime.now(timezone.utc) - max_age
+
+
+# Cheap check whether a sync has anything to do, in two requests and without
+# importing requests, loading the stored tasks or the course list: one asks
+# Todoist for changes since the stored sync token (without saving them, the sync
+# that follows does that), the other fetches the planner items of every selected
+# course, which carry the due dates, names and submission states of their
+# assignments. Anything unexpected counts as a change.
+# The check only trusts the stored state when the last sync finished. Time alone
+# changes the result once a locked assignment comes within reach of its unlock
+# date, which the last sync stored as next_unlock, and once the statistics are
+# due for a recount, which also catches assignments without a due date (the
+# planner does not list those)
+def nothing_changed(account):
+    if not account.config:
+        read_config(account)
+    if account.state_db is None:
+        open_state(account)
+    if not account.config.get("courses"):
+        return False
+    token = state_get(account, "todoist_sync_token")
+    stats = state_get(account, "assignment_stats")
+    next_unlock = state_get(account, "next_unlock")
+    sync_due = (
+        token is None
+        or stats is None
+        or state_get(account, "last_sync_complete") != "1"
+        or bool(pending_journal(account))
+        or stats_expired(account, AssignmentStats.from_json(stats))
+        or bool(next_unlock)
+        and datetime.fromisoformat(next_unlock) <= datetime.now(timezone.utc)
+    )
+    if not sync_due:
+        sync_due = todoist_changed(account, token)
+    # The planner is checked even when a sync is due, for the fingerprint that
+    # sync stores once it finishes
+    return planner_unchanged(account) and not sync_due
+
+
+# Whether Todoist reports changed projects or tasks since the sync token
+def todoist_changed(account, token):
+    form = urlencode({"sync_token": token, "resource_types": json.dumps(["projects", "items"])})
+    result = probe_request(
+        account, "todoist", "sync", todoist_sync_url, account.todoist_header, form.encode()
+    )
+    if result is None or result[0] != 200:
+        return True
+    response = json.loads(result[2])
+    return bool(response.get("items") or response.get("projects"))
+
+
+# Whether the planner items of the selected courses from today on are the ones
+# the last finished sync saw. Their fingerprint (the URL, ETag and digest of every
+# page) is kept in account.planner_fingerprint for the sync to store once it
+# finishes; if the items are unchanged it is stored right away. Pages are
+# revalidated with If-None-Match, so unchanged ones come back empty
+def planner_unchanged(account):
+    course_codes = [f"course_{course_id}" for course_id in sorted(map(int, account.config["courses"]))]
+    query = urlencode(
+        {
+            "per_page": 100,
+            "start_date": datetime.now(timezone.utc).date().isoformat(),
+            "context_codes[]": course_codes,
+        },
+        doseq=True,
+    )
+    url = f"{account.config['canvas_api_heading']}/api/v1/planner/items?{query}"
+    stored = json.loads(state_get(account, "planner_fingerprint") or "[]")
+    pages = []
+    unchanged = True
+    while url:
+        known = stored[len(pages)] if len(pages) < len(stored) else None
+        if known is not None and known[0] != url:
+            known = None
+        headers = dict(account.header)
+        if known is not None and known[1]:
+            headers["If-None-Match"] = known[1]
+        result = probe_request(account, "canvas", canvas_endpoint(url), url, headers)
+        if result is None:
+            return False
+        status, response_headers, body = result
+        if status == 304 and known is not None:
+            pages.append(known)
+            url = stored[len(pages)][0] if len(pages) < len(stored) else None
+            continue
+        if status != 200:
+            return False
+        page = [url, response_headers.get("ETag"), hashlib.sha256(body).hexdigest()]
+        unchanged = unchanged and known is not None and known[2] == page[2]
+        pages.append(page)
+        match = re.search(r'<([^>]+)>;\s*rel="next"', response_headers.get("Link") or "")
+        url = match.group(1) if match else None
+    account.planner_fingerprint = json.dumps(pages)
+    if not unchanged or len(pages) != len(stored):
+        return False
+    with account.state_db:
+        state_set(account, "planner_fingerprint", account.planner_fingerprint)
+    return True
+
+
+# Sends one request of the nothing_changed check through urllib. Returns the
+# status, headers and body, or None if the request did not get an answer
+def probe_request(account, service, endpoint, url, headers, data=None):
+    import urllib.error
+    import urllib.request
+
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(
+            urllib.request.Request(url, data=data, headers=headers), timeout=request_timeout
+        ) as response:
+            result = response.status, response.headers, response.read()
+    except urllib.error.HTTPError as error:
+        result = error.code, error.headers, b""
+    except OSError:
+        result = None
+    account.metrics.observe(
+        service, endpoint, result[0] if result else "error", time.perf_counter() - start
+    )
+    return result
+
+
+# Syncs every account on a pool of workers threads. A failing account is logged
+# and does not stop the others; returns whether all of them succeeded
+def sync_accounts(accounts, workers, full=True):
+    def sync_one(account):
+        return measured_pass(account, sync, full)
+
+    if len(accounts) == 1:
+        results = [sync_one(accounts[0])]
+    else:
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            results = list(executor.map(sync_one, accounts))
+        print(f"Synced {sum(results)} of {len(accounts)} accounts")
+    write_prometheus(accounts)
+    return all(results)
+
+
+# Runs one pass over an account, logging a failure instead of raising it, and
+# records the outcome in its metrics; returns whether the pass succeeded
+def measured_pass(account, run, *args):
+    try:
+        run(account, *args)
+        account.metrics.result = "ok"
+    except Exception as error:
+        account.log(f"Sync failed: {error}")
+        account.metrics.result = "failed"
+    log_metrics(account)
+    return account.metrics.result == "ok"
+
+
+# Config files to sync in batch mode: every *.json file in a directory, or the
+# paths listed one per line in a manifest file (relative to the manifest)
+def batch_config_paths(path):
+    if os.path.isdir(path):
+        return sorted(glob.glob(os.path.join(path, "*.json")))
+    base = os.path.dirname(path)
+    with open(path) as manifest:
+        lines = [line.strip() for line in manifest]
+    return [
+        os.path.join(base, line) for line in lines if line and not line.startswith("#")
+    ]
+
+
+# Keeps syncing every interval seconds (plus or minus jitter) until SIGTERM or
+# SIGINT. Sessions and state stores stay open between passes; every
+# full_every-th pass is a full reconcile, the others stop early when nothing changed
+def run_daemon(accounts, workers, interval, jitter, full_every):
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+    passes = 0
+    while not stop_event.is_set():
+        full = passes % max(1, full_every) == 0
+        sync_accounts(accounts, workers, full=full)
+        passes += 1
+        delay = max(0, interval + uniform(-jitter, jitter))
+        print(f"Next sync in {delay:.0f} seconds")
+        stop_event.wait(delay)
+    print("Stopping daemon")
+    for account in accounts:
+        if account.state_db is not None:
+            account.state_db.close()
+
+
+def request_stop(signum, frame):
+    stop_event.set()
+
+
+# Listener mode: syncs once in full, then serves Todoist webhooks on /todoist and
+# Canvas Live Events (or anything posting the same payloads) on /canvas. Each
+# event names one assignment; bursts are debounced and coalesced by
+# PendingEvents and synced by sync_assignment_changes without downloading whole
+# courses. A quick sync still runs after interval seconds without events, in case
+# an event was missed
+def run_listener(account, host, port, debounce, interval):
+    # Imported here so the other commands do not pay for http.server
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class WebhookHandler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            self.send_response(handle_event(account, pending, self.path, self.headers, body))
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+    # The event secrets come from the config, so it is loaded before the first
+    # event can arrive
+    initialize_api(account)
+    pending = PendingEvents(debounce)
+    server = ThreadingHTTPServer((host, port), WebhookHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    account.log(f"Listening for events on http://{host}:{server.server_address[1]}")
+    sync_accounts([account], 1)
+    last_sync = time.monotonic()
+    while not stop_event.is_set():
+        batch = pending.take(max(0, last_sync + interval - time.monotonic()))
+        if batch is not None:
+            targets, events = batch
+            account.log(
+                f"Syncing {sum(map(len, targets.values()))} assignments changed by {events} events"
+            )
+            measured_pass(account, sync_assignment_changes, targets)
+            write_prometheus([account])
+        elif not stop_event.is_set():
+            sync_accounts([account], 1, full=False)
+        last_sync = time.monotonic()
+    server.shutdown()
+    print("Stopping listener")
+    if account.state_db is not None:
+        account.state_db.close()
+
+
+# Assignments named by incoming events, waiting to be synced. Repeated events for
+# an assignment coalesce into one entry, and the batch is handed out once no
+# event has arrived for debounce seconds, or listen_max_wait debounce periods
+# after the first so a steady stream of events still gets synced
+class PendingEvents:
+    def __init__(self, debounce):
+        self.debounce = debounce
+        self.condition = threading.Condition()
+        self.targets = {}  # Course id -> ids of its changed assignments
+        self.events = 0
+        self.first = None
+        self.last = None
+
+    def add(self, course_id, assignment_id):
+        with self.condition:
+            self.targets.setdefault(course_id, set()).add(assignment_id)
+            self.events += 1
+            self.last = time.monotonic()
+            if self.first is None:
+                self.first = self.last
+            self.condition.notify()
+
+    # Returns (targets, number of events) once a batch is ready, or None after
+    # timeout seconds without events or when the listener stops
+    def take(self, timeout):
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while not stop_event.is_set():
+                now = time.monotonic()
+                if self.targets:
+                    ready_at = min(
+                        self.last + self.debounce,
+                        self.first + self.debounce * listen_max_wait,
+                    )
+                    if now >= ready_at:
+                        batch = (self.targets, self.events)
+                        self.targets, self.events, self.first, self.last = {}, 0, None, None
+                        return batch
+                elif now >= deadline:
+                    return None
+                else:
+                    ready_at = deadline
+                # Wake up every second to notice a stop request
+                self.condition.wait(min(ready_at - now, 1))
+        return None
+
+
+# Checks an event posted to the listener and queues the assignment it names in
+# pending, returning the HTTP status to answer with right away; the listener loop
+# does the work. Todoist webhooks are checked against "todoist_client_secret"
+# and Canvas events against "canvas_events_secret" (sent as a Bearer token) when
+# those are set in the config
+def handle_event(account, pending, path, headers, body):
+    config = account.config
+    if path == "/todoist":
+        secret = config.get("todoist_client_secret")
+        expected = secret and base64.b64encode(
+            hmac.new(secret.encode(), body, hashlib.sha256).digest()
+        ).decode()
+        parse = todoist_event_target
+        signature = headers.get("X-Todoist-Hmac-SHA256", "")
+    elif path == "/canvas":
+        secret = config.get("canvas_events_secret")
+        expected = secret and f"Bearer {secret}"
+        parse = canvas_event_target
+        signature = headers.get("Authorization", "")
+    else:
+        return 404
+    if expected and not hmac.compare_digest(signature.encode(), expected.encode()):
+        return 401
+    try:
+        target = parse(json.loads(body))
+    except (ValueError, AttributeError, TypeError):
+        return 400
+    if target is not None:
+        pending.add(*target)
+    return 200
+
+
+# Canvas Live Events about an assignment or a submission to it
+canvas_assignment_events = frozenset(
+    ["assignment_created", "assignment_updated", "submission_created", "submission_updated"]
+)
+# Todoist webhook events after which a task is checked against its assignment
+todoist_task_events = frozenset(["item:updated", "item:uncompleted"])
+
+
+# Live Events may carry global ids, which add the shard id times 10^13 to the id
+# the REST API and config.json use
+def canvas_local_id(value):
+    return int(value) % 10**13
+
+
+# The (course id, assignment id) a Canvas Live Event is about, or None
+def canvas_event_target(event):
+    metadata = event.get("metadata") or {}
+    body = event.get("body") or {}
+    if metadata.get("event_name") not in canvas_assignment_events or not body.get("assignment_id"):
+        return None
+    for context in (body, metadata):
+        if context.get("context_type") == "Course" and context.get("context_id"):
+            return canvas_local_id(context["context_id"]), canvas_local_id(body["assignment_id"])
+    return None
+
+
+# The (course id, assignment id) a Todoist webhook is about, taken from the
+# assignment link in the task content, or None for tasks not made from Canvas
+def todoist_event_target(event):
+    if event.get("event_name") not in todoist_task_events:
+        return None
+    content = (event.get("event_data") or {}).get("content") or ""
+    match = re.search(r"/courses/(\d+)/assignments/(\d+)", content)
+    if match is None:
+        return None
+    return int(match.group(1)), int(match.group(2))
+
+
+# Syncs only the assignments named by events, through the same matching, add and
+# update logic as a full sync: Todoist is brought up to date with one incremental
+# request, and each assignment is loaded on its own unless so many in a course
+# changed that loading its assignment list is cheaper. Courses not selected in the
+# config are ignored
+def sync_assignment_changes(account, targets):
+    account.reset()
+    metrics = account.metrics
+    with metrics.span("total"):
+        if not account.started:
+            with metrics.span("start"):
+                start_account(account)
+        targets = {
+            course_id: assignment_ids
+            for course_id, assignment_ids in targets.items()
+            if course_id in account.course_ids
+        }
+        if not targets:
+            return
+        # Only the named assignments are synced, so the next --quick run does a
+        # full sync
+        with account.state_db:
+            state_set(account, "last_sync_complete", "0")
+        with metrics.span("todoist_state"):
+            replay_journal(account)
+            sync_todoist_state(account)
+            load_todoist_projects(account)
+            load_todoist_tasks(account)
+        with metrics.span("create_projects"):
+            create_todoist_projects(account)
+        seen = SeenAssignments()
+        with metrics.span("assignments"):
+            transfer_assignments_to_todoist(
+                account, seen.recorded(load_changed_assignments(account, targets))
+            )
+        with metrics.span("reconcile"):
+            reconcile_todoist_tasks(account, seen, complete=False)
+
+
+def load_changed_assignments(account, targets):
+    heading = account.config["canvas_api_heading"]
+    for course_id, assignment_ids in targets.items():
+        if len(assignment_ids) > listen_course_threshold:
+            for page in load_course_pages(account, course_id, candidate_param):
+                yield from page
+            continue
+        for assignment_id in assignment_ids:
+            response = canvas_get(
+                account,
+                f"{heading}/api/v1/courses/{course_id}/assignments/{assignment_id}",
+                assignment_param,
+            )
+            if response.status_code == 404:
+                account.log(f"Assignment {assignment_id} is no longer in Canvas")
+                continue
+            if response.status_code != 200:
+                raise SyncError(f"Canvas answered {response.status_code} for assignment {assignment_id}")
+            yield from parse_assignments(account, [response.json()])
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Transfer Canvas assignments to Todoist"
+    )
+    parser.add_argument(
+        "command",
+        nargs="?",
+        choices=["sync", "plan", "apply", "listen"],
+        default="sync",
+        help="sync (default) diffs and writes to Todoist in one go; plan only works out "
+        "the changes and saves them to --plan-file; apply sends a saved plan, resuming "
+        "where an earlier apply stopped; listen syncs once, then syncs the assignments "
+        "named by Todoist webhooks and Canvas Live Events as they arrive",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="download every Canvas response in full instead of revalidating cached copies",
+    )
+    parser.add_argument(
+        "--quick",
+        action="store_true",
+        help="for frequent scheduled runs: first check cheaply whether Canvas or Todoist changed, and exit quietly if not",
+    )
+    parser.add_argument(
+        "--daemon",
+        action="store_true",
+        help="keep running and sync again every --interval seconds",
+    )
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=900,
+        help="seconds between syncs in daemon mode, or without events in listen mode (default 900)",
+    )
+    parser.add_argument(
+        "--jitter",
+        type=float,
+        default=60,
+        help="random seconds added to or taken from each interval (default 60)",
+    )
+    parser.add_argument(
+        "--full-every",
+        type=int,
+        default=4,
+        help="run a full reconcile every N syncs in daemon mode, even without changes (default 4)",
+    )
+    parser.add_argument(
+        "--batch",
+        metavar="PATH",
+        help="sync many accounts: a directory of config files or a manifest listing one config path per line",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=batch_workers,
+        help=f"accounts synced at the same time with --batch (default {batch_workers})",
+    )
+    parser.add_argument(
+        "--metrics-log",
+        metavar="FILE",
+        help="append phase timings, request counts and latencies of every sync to FILE as JSON lines (- for stdout)",
+    )
+    parser.add_argument(
+        "--prometheus",
+        metavar="FILE",
+        help="write the metrics of the last sync to FILE in the Prometheus text format, e.g. for the node_exporter textfile collector",
+    )
+    parser.add_argument(
+        "--host",
+        default="127.0.0.1",
+        help="address listen mode accepts events on (default 127.0.0.1)",
+    )
+    parser.add_argument(
+        "--port",
+        type=int,
+        default=8765,
+        help="port listen mode accepts events on (default 8765)",
+    )
+    parser.add_argument(
+        "--debounce",
+        type=float,
+        default=5,
+        help="seconds listen mode waits for more events before syncing (default 5)",
+    )
+    parser.add_argument(
+        "--plan-file",
+        default="plan.json",
+        help="file plan writes and apply reads (default plan.json)",
+    )
+    parser.add_argument(
+        "--rate",
+        type=float,
+        help="Todoist requests per minute while applying a plan (default: as fast as Todoist allows)",
+    )
+    args = parser.parse_args(argv)
+    if args.command != "sync" and (args.batch or args.daemon):
+        parser.error(f"{args.command} works on a single account and cannot be combined with --batch or --daemon")
+    return args
 
 
 # Function for Yes/No response prompts during setup
@@ -54,23 +795,121 @@ def yes_no(question: str) -> bool:
 
 
 # Makes sure that the user has their api keys and canvas url in the config.json
-def initialize_api():
-    global config
-    global todoist_api
+# Loads the config and sets up the API sessions of an account
+def initialize_api(account):
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    if not account.config:
+        read_config(account)
+    account.canvas_session = requests.Session()
+    account.todoist_session = requests.Session()
+    # Size the connection pool so every concurrent course load keeps its connection alive
+    adapter = HTTPAdapter(pool_maxsize=max(1, canvas_workers(account)))
+    account.canvas_session.mount("https://", adapter)
+    account.canvas_session.mount("http://", adapter)
 
+
+def read_config(account):
     try:
-        with open("config.json") as config_file:
-            config = json.load(config_file)
+        with open(account.config_path) as config_file:
+            account.config = json.load(config_file)
     except FileNotFoundError:
+        if not account.interactive:
+            raise SyncError(f"{account.config_path} not found")
         print("File not Found, running Initial Configuration")
-        initial_config()
+        initial_config(account)
+    config = account.config
+
+    account.todoist_header.update(
+        {"Authorization": f"Bearer {config['todoist_api_key'].strip()}"}
+    )
+    account.header.update(
+        {"Authorization": f"Bearer {config['canvas_api_key'].strip()}"}
+    )
+
+
+def canvas_workers(account):
+    return int(account.config.get("canvas_max_workers", canvas_max_workers))
 
-    # create todoist_api object globally
-    todoist_api = TodoistAPI(config["todoist_api_key"].strip())
-    header.update({"Authorization": f"Bearer {config['canvas_api_key'].strip()}"})
 
+# GET request against the Canvas API through the shared session. Responses seen
+# before are revalidated with If-None-Match/If-Modified-Since and a 304 is
+# answered from the cache as if Canvas had sent the full body again
+def canvas_get(account, url, params=None):
+    if not account.use_cache:
+        response = canvas_send(account, url, params, account.header)
+        response.from_cache = False
+        return response
+    key = f"{url}{'&' if '?' in url else '?'}{urlencode(params, doseq=True)}" if params else url
+    cached = cache_lookup(account, key)
+    headers = dict(account.header)
+    if cached is not None:
+        etag, last_modified, link, body = cached
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+    response = canvas_send(account, url, params, headers)
+    response.from_cache = response.status_code == 304 and cached is not None
+    if response.from_cache:
+        # Turn the 304 into the cached 200 so callers can read json() and links
+        response.status_code = 200
+        response._content = body
+        if link:
+            response.headers["Link"] = link
+    elif response.status_code == 200:
+        cache_store(account, key, response)
+    return response
 
-def initial_config():  # Initial configuration for first time users
+
+# Sends a GET to Canvas, pacing requests with the X-Rate-Limit-Remaining header
+# and retrying throttled responses and dropped connections. With a body it
+# POSTs that as JSON instead
+def canvas_send(account, url, params, headers, body=None):
+    limiter = account.canvas_limiter
+    for attempt in range(max_retries + 1):
+        limiter.acquire(canvas_preflight_cost)
+        start = time.perf_counter()
+        try:
+            if body is None:
+                response = account.canvas_session.get(
+                    url, headers=headers, params=params, timeout=request_timeout
+                )
+            else:
+                response = account.canvas_session.post(
+                    url, headers=headers, json=body, timeout=request_timeout
+                )
+        except Exception as error:
+            limiter.settle(canvas_preflight_cost)
+            account.metrics.observe(
+                "canvas", canvas_endpoint(url), "error", time.perf_counter() - start
+            )
+            if not network_error(error) or attempt == max_retries:
+                raise
+            delay = retry_delay(attempt)
+            account.log(f"Canvas request failed ({error}), retrying in {delay:.1f} seconds...")
+            time.sleep(delay)
+            continue
+        account.metrics.observe(
+            "canvas", canvas_endpoint(url), response.status_code, time.perf_counter() - start
+        )
+        # Canvas reports what the request actually cost next to the headroom left;
+        # the cost only matters when the headroom is missing
+        remaining = response.headers.get("X-Rate-Limit-Remaining")
+        cost = response.headers.get("X-Request-Cost")
+        limiter.settle(
+            canvas_preflight_cost,
+            float(remaining) if remaining is not None else None,
+            float(cost) if cost is not None else None,
+        )
+        if not canvas_throttled(response) or attempt == max_retries:
+            return response
+        limiter.back_off(retry_after(response) or retry_delay(attempt))
+
+
+def initial_config(account):  # Initial configuration for first time users
+    config = account.config
     print(
         "Your Todoist API key has not been configured. To add an API token, go to your Todoist settings and copy the API token listed under the Integrations Tab. Copy the token and paste below when you are done."
     )
@@ -123,7 +962,7 @@ def initial_config():  # Initial configuration for first time users
             config["sync_locked_assignments"] = True
             config["sync_no_due_date_assignments"] = True
     config["courses"] = []
-    with open("config.json", "w") as outfile:
+    with open(account.config_path, "w") as outfile:
         json.dump(config, outfile)
 
 
@@ -131,32 +970,42 @@ def initial_config():  # Initial configuration for first time users
 # that has course ids as the keys and their names as the values
 
 
-def select_courses():
-    global config
+def select_courses(account):
+    config = account.config
+    courses_id_name_dict = account.courses_id_name_dict
+
+    # Warm runs take the course names stored by an earlier run instead of asking
+    # Canvas for the course list again
+    if config["courses"]:
+        stored = dict(account.state_db.execute("SELECT id, name FROM courses"))
+        if all(str(course_id) in stored for course_id in config["courses"]):
+            account.course_ids.extend(int(course_id) for course_id in config["courses"])
+            for course_id in account.course_ids:
+                courses_id_name_dict[course_id] = stored[str(course_id)]
+            return
 
     try:
-        response = requests.get(
-            f"{config['canvas_api_heading']}/api/v1/courses",
-            headers=header,
-            params=param,
+        response = canvas_get(
+            account, f"{config['canvas_api_heading']}/api/v1/courses", param
         )
-        if response.status_code == 401:
-            print("Unauthorized; Check API Key")
-            exit()
-        # Note that only courses in "Active" state are returned
-        if config["courses"]:
-            course_ids.extend(
-                list(map(lambda course_id: int(course_id), config["courses"]))
-            )
-            for course in response.json():
-                courses_id_name_dict[course.get("id", None)] = re.sub(
-                    r"[^-a-zA-Z0-9._\s]", "", course.get("name", "")
-                )
-            return
     except Exception as error:
-        print(f"Error while loading courses: {error}")
-        print(f"Check API Key and Canvas URL")
-        exit()
+        account.log(f"Error while loading courses: {error}")
+        raise SyncError("Check API Key and Canvas URL")
+    if response.status_code == 401:
+        raise SyncError("Unauthorized; Check API Key")
+    store_course_names(account, response.json())
+    # Note that only courses in "Active" state are returned
+    if config["courses"]:
+        account.course_ids.extend(
+            list(map(lambda course_id: int(course_id), config["courses"]))
+        )
+        for course in response.json():
+            courses_id_name_dict[course.get("id", None)] = re.sub(
+                r"[^-a-zA-Z0-9._\s]", "", course.get("name", "")
+            )
+        return
+    if not account.interactive:
+        raise SyncError(f"No courses selected in {account.config_path}")
 
     # If the user does not choose to use courses selected last time
     for i, course in enumerate(response.json(), start=1):
@@ -164,16 +1013,16 @@ def select_courses():
             r"[^-a-zA-Z0-9._\s]", "", course.get("name", "")
         )
         if course.get("name") is not None:
-            print(
+            account.log(
                 f"{str(i)} ) {courses_id_name_dict[course.get('id', '')]} : {str(course.get('id', ''))}"
             )
 
-    print(
+    account.log(
         "\nEnter the courses you would like to add to Todoist by entering the numbers of the items you would like to select. Separate numbers with spaces."
     )
     my_input = input(">")
     input_array = my_input.split()
-    course_ids.extend(
+    account.course_ids.extend(
         list(
             map(
                 lambda item: response.json()[int(item) - 1].get("id", None), input_array
@@ -181,240 +1030,876 @@ def select_courses():
         )
     )
 
-    # write course ids to config.json
-    config["courses"] = course_ids
-    with open("config.json", "w") as outfile:
+    # write course ids to the config file
+    config["courses"] = account.course_ids
+    with open(account.config_path, "w") as outfile:
         json.dump(config, outfile)
 
 
-# Iterates over the course_ids list and loads all of the users assignments
-# for those classes. Appends assignment objects to assignments list
-def load_assignments():
-    try:
-        for course_id in course_ids:
-            response = requests.get(
-                f"{config['canvas_api_heading']}/api/v1/courses/{str(course_id)}/assignments",
-                headers=header,
-                params=param,
-            )
-            if response.status_code == 401:
-                print("Unauthorized; Check API Key")
-                exit()
-            paginated = response.json()
-            while "next" in response.links:
-                sleep()  # Throttle requests to Canvas API to prevent rate limiting on multiple pages
-                response = requests.get(
-                    response.links["next"]["url"], headers=header, params=param
+# Keeps the sanitized names of the listed courses, leaving their project ids alone
+def store_course_names(account, courses):
+    with account.state_db:
+        account.state_db.executemany(
+            "INSERT INTO courses (id, name) VALUES (?, ?)"
+            " ON CONFLICT(id) DO UPDATE SET name = excluded.name",
+            [
+                (str(course["id"]), re.sub(r"[^-a-zA-Z0-9._\s]", "", course.get("name", "")))
+                for course in courses
+                if course.get("id") is not None
+            ],
+        )
+
+
+# Streams the users assignments for every course in course_ids as pages arrive.
+# Courses download concurrently, and assignments are yielded course by course in
+# course_ids order, so matching and Todoist writes start while later courses are
+# still loading. With "canvas_loader": "graphql" in the config the assignments
+# come from stream_graphql_assignments instead, falling back to this REST loader
+# if the GraphQL query fails before returning anything. Unless everything is set,
+# the REST loader asks Canvas for the assignments not yet past due only
+def stream_assignments(account, everything=True):
+    if account.config.get("canvas_loader", "rest") == "graphql":
+        loaded = False
+        try:
+            for assignment in stream_graphql_assignments(account):
+                loaded = True
+                yield assignment
+            return
+        except Exception as error:
+            if loaded:
+                raise SyncError(f"Canvas GraphQL loader failed: {error}")
+            account.log(f"Canvas GraphQL loader failed ({error}), loading assignments over REST")
+    yield from stream_rest_assignments(
+        account, assignment_param if everything else candidate_param
+    )
+
+
+# Streams the assignments of every selected course in course order while up to
+# canvas_workers courses download concurrently. Each course buffers at most
+# course_page_buffer pages, and downloads stop once the caller stops reading
+def stream_rest_assignments(account, params):
+    course_pages = {
+        course_id: queue.Queue(maxsize=course_page_buffer) for course_id in account.course_ids
+    }
+    abandoned = threading.Event()
+
+    def put(course_id, item):
+        while not abandoned.is_set():
+            try:
+                course_pages[course_id].put(item, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def download(course_id):
+        try:
+            for page in load_course_pages(account, course_id, params):
+                if not put(course_id, page):
+                    return
+            put(course_id, None)
+        except Exception as error:
+            put(course_id, error)
+
+    total = 0
+    with ThreadPoolExecutor(max_workers=max(1, canvas_workers(account))) as executor:
+        try:
+            for course_id in account.course_ids:
+                executor.submit(download, course_id)
+            for course_id in account.course_ids:
+                loaded = 0
+                while True:
+                    page = course_pages[course_id].get()
+                    if page is None:
+                        break
+                    if isinstance(page, SyncError):
+                        raise page
+                    if isinstance(page, Exception):
+                        account.log(f"Error while loading Assignments: {page}")
+                        raise SyncError("Check or regenerate API Key and Canvas URL")
+                    loaded += len(page)
+                    yield from page
+                account.log(
+                    f"Loaded {loaded} Assignments for Course {account.courses_id_name_dict[course_id]}"
                 )
-                paginated.extend(response.json())
-            print(
-                f"Loaded {len(paginated)} Assignments for Course {courses_id_name_dict[course_id]}"
+                total += loaded
+        finally:
+            # Drops the downloads not started yet and lets those blocked on a full
+            # buffer end, so the pool can shut down
+            executor.shutdown(wait=False, cancel_futures=True)
+            abandoned.set()
+    account.log(f"Loaded {total} Total Canvas Assignments")
+
+
+# Loads every page of assignments for a single course, one page at a time
+def load_course_pages(account, course_id, params):
+    response = canvas_get(
+        account,
+        f"{account.config['canvas_api_heading']}/api/v1/courses/{str(course_id)}/assignments",
+        params,
+    )
+    if response.status_code == 401:
+        raise SyncError("Unauthorized; Check API Key")
+    yield parse_assignments(account, response.json())
+    while "next" in response.links:
+        # The next link already carries the query parameters
+        response = canvas_get(account, response.links["next"]["url"])
+        yield parse_assignments(account, response.json())
+
+
+# Fields of each assignment requested by the GraphQL loader, the GraphQL names of
+# what Assignment.from_canvas reads
+graphql_assignment_fields = """
+    _id name htmlUrl dueAt unlockAt updatedAt submissionTypes gradedSubmissionsExist
+    lockInfo { isLocked }
+    submissionsConnection(first: 1) { nodes { state gradedAt } }
+"""
+
+
+# Loads the assignments of every selected course through Canvas' GraphQL API.
+# Each request asks for the next page of up to 100 assignments of every course
+# that has more, so all courses together take as many requests as the largest
+# course has pages, and only the fields the sync reads are sent
+def stream_graphql_assignments(account):
+    url = f"{account.config['canvas_api_heading']}/api/graphql"
+    cursors = {course_id: None for course_id in account.course_ids}
+    loaded = Counter()
+    while cursors:
+        # One aliased course field per course, each with its own page cursor
+        aliases = {f"c{i}": course_id for i, course_id in enumerate(cursors)}
+        variables = ", ".join(f"${alias}: String" for alias in aliases)
+        selections = " ".join(
+            f'{alias}: course(id: "{course_id}") {{ '
+            f"assignmentsConnection(first: 100, after: ${alias}) {{ "
+            f"nodes {{ {graphql_assignment_fields} }} "
+            "pageInfo { hasNextPage endCursor } } }"
+            for alias, course_id in aliases.items()
+        )
+        query = f"query Assignments({variables}) {{ {selections} }}"
+        response = canvas_send(
+            account,
+            url,
+            None,
+            account.header,
+            body={
+                "query": query,
+                "variables": {alias: cursors[course_id] for alias, course_id in aliases.items()},
+            },
+        )
+        if response.status_code == 401:
+            raise SyncError("Unauthorized; Check API Key")
+        response.raise_for_status()
+        result = response.json()
+        if result.get("errors"):
+            raise SyncError(result["errors"][0].get("message", result["errors"]))
+        data = result["data"]
+        cursors = {}
+        for alias, course_id in aliases.items():
+            if data.get(alias) is None:
+                account.canvas_incomplete = True
+                account.log(f"Course {course_id} not found through GraphQL")
+                continue
+            connection = data[alias]["assignmentsConnection"]
+            records = []
+            for node in connection["nodes"]:
+                try:
+                    records.append(Assignment.from_graphql(node, course_id))
+                except ValueError as e:
+                    account.canvas_incomplete = True
+                    account.log(
+                        f"Skipping assignment due to invalid date: {node.get('name')} - {e}"
+                    )
+            loaded[course_id] += len(records)
+            yield from records
+            if connection["pageInfo"]["hasNextPage"]:
+                cursors[course_id] = connection["pageInfo"]["endCursor"]
+    for course_id in account.course_ids:
+        account.log(
+            f"Loaded {loaded[course_id]} Assignments for Course {account.courses_id_name_dict[course_id]}"
+        )
+    account.log(f"Loaded {sum(loaded.values())} Total Canvas Assignments")
+
+
+# Converts a GraphQL timestamp, which may carry any UTC offset, to the fixed
+# UTC format of the REST API
+def graphql_time(value):
+    if value is None:
+        return None
+    utc = datetime.fromisoformat(value).astimezone(timezone.utc)
+    return utc.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+# Turns a page of raw Canvas assignment JSON into Assignment records, so the raw
+# dicts can be dropped as soon as the page is parsed
+def parse_assignments(account, items):
+    records = []
+    for raw in items:
+        try:
+            records.append(Assignment.from_canvas(raw))
+        except ValueError as e:
+            account.canvas_incomplete = True
+            account.log(
+                f"Skipping assignment due to invalid date: {raw.get('name')} - {e}"
             )
-            assignments.extend(paginated)
-        print(f"Loaded {len(assignments)} Total Canvas Assignments")
+    return records
+
+
+# Parses a Canvas UTC timestamp such as "2024-09-01T06:59:00Z" into an aware
+# datetime. Canvas always sends this fixed format, so the fields are sliced out
+# directly instead of going through strptime; many assignments share the same
+# due time, so results are cached
+@lru_cache(maxsize=4096)
+def parse_canvas_time(value):
+    if value is None:
+        return None
+    if (
+        len(value) != 20
+        or value[4] != "-"
+        or value[7] != "-"
+        or value[10] != "T"
+        or value[13] != ":"
+        or value[16] != ":"
+        or value[19] != "Z"
+    ):
+        raise ValueError(f"time data {value!r} does not match format '%Y-%m-%dT%H:%M:%SZ'")
+    return datetime(
+        int(value[0:4]),
+        int(value[5:7]),
+        int(value[8:10]),
+        int(value[11:13]),
+        int(value[14:16]),
+        int(value[17:19]),
+        tzinfo=timezone.utc,
+    )
+
+
+# The parts of a Canvas assignment the sync reads. Canvas sends dozens of fields
+# per assignment (plus the embedded submission); keeping only these, with the
+# timestamps parsed once, makes each record a fraction of the raw JSON dict
+@dataclass(slots=True)
+class Assignment:
+    id: int
+    course_id: int
+    name: str
+    html_url: str
+    updated_at: Optional[str]  # Kept as sent, only compared for equality
+    due_at: Optional[datetime]
+    unlock_at: Optional[datetime]
+    locked_for_user: bool
+    lock_explanation: Optional[str]
+    submission_type: Optional[str]  # First entry of submission_types
+    graded_submissions_exist: bool
+    workflow_state: str  # State of the user's submission
+    graded_at: Optional[datetime]
+
+    @classmethod
+    def from_canvas(cls, raw):
+        submission = raw.get("submission") or {}
+        submission_types = raw.get("submission_types") or [None]
+        return cls(
+            id=raw["id"],
+            course_id=raw["course_id"],
+            name=raw["name"],
+            html_url=raw["html_url"],
+            updated_at=raw.get("updated_at"),
+            due_at=parse_canvas_time(raw.get("due_at")),
+            unlock_at=parse_canvas_time(raw.get("unlock_at")),
+            locked_for_user=raw.get("locked_for_user", False),
+            lock_explanation=raw.get("lock_explanation"),
+            submission_type=submission_types[0],
+            graded_submissions_exist=raw.get("graded_submissions_exist", False),
+            workflow_state=submission.get("workflow_state", "unsubmitted"),
+            graded_at=parse_canvas_time(submission.get("graded_at")),
+        )
+
+    # Builds the record from an assignment node of the GraphQL loader
+    @classmethod
+    def from_graphql(cls, node, course_id):
+        submissions = (node.get("submissionsConnection") or {}).get("nodes") or [{}]
+        submission_types = node.get("submissionTypes") or [None]
+        return cls(
+            id=int(node["_id"]),
+            course_id=course_id,
+            name=node["name"],
+            html_url=node["htmlUrl"],
+            updated_at=graphql_time(node.get("updatedAt")),
+            due_at=parse_canvas_time(graphql_time(node.get("dueAt"))),
+            unlock_at=parse_canvas_time(graphql_time(node.get("unlockAt"))),
+            locked_for_user=(node.get("lockInfo") or {}).get("isLocked", False),
+            lock_explanation=None,
+            submission_type=submission_types[0] and submission_types[0].lower(),
+            graded_submissions_exist=node.get("gradedSubmissionsExist") or False,
+            workflow_state=(submissions[0] or {}).get("state") or "unsubmitted",
+            graded_at=parse_canvas_time(graphql_time((submissions[0] or {}).get("gradedAt"))),
+        )
+
+
+# Opens the local state store, creating its tables on first use. It keeps a copy
+# of the user's Todoist projects and tasks, the last Todoist sync token, the name
+# and Todoist project of every course, and for
+# every synced assignment its Canvas updated_at and the task that tracks it
+def open_state(account):
+    account.state_db = sqlite3.connect(account.state_path, check_same_thread=False)
+    account.state_db.executescript(
+        """
+        CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+        CREATE TABLE IF NOT EXISTS projects (id TEXT PRIMARY KEY, name TEXT);
+        CREATE TABLE IF NOT EXISTS courses (id TEXT PRIMARY KEY, name TEXT, project_id TEXT);
+        CREATE TABLE IF NOT EXISTS tasks (
+            id TEXT PRIMARY KEY, project_id TEXT, content TEXT, description TEXT,
+            labels TEXT
+        );
+        CREATE TABLE IF NOT EXISTS assignments (
+            id TEXT PRIMARY KEY, updated_at TEXT, task_id TEXT
+        );
+        CREATE TABLE IF NOT EXISTS journal (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT, uuid TEXT, kind TEXT,
+            command TEXT, assignment TEXT, result TEXT
+        );
+        CREATE INDEX IF NOT EXISTS journal_uuid ON journal (uuid);
+        CREATE TABLE IF NOT EXISTS http_cache (
+            url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, link TEXT,
+            body BLOB, size INTEGER, used_at REAL
+        );
+        """
+    )
+    # State stores from before task labels were kept get the column, and a full
+    # Todoist sync to fill it in
+    columns = [row[1] for row in account.state_db.execute("PRAGMA table_info(tasks)")]
+    if "labels" not in columns:
+        with account.state_db:
+            account.state_db.execute("ALTER TABLE tasks ADD COLUMN labels TEXT")
+            account.state_db.execute("DELETE FROM meta WHERE key = 'todoist_sync_token'")
+
+
+# Returns (etag, last_modified, link, body) of a cached Canvas response, or None
+def cache_lookup(account, key):
+    state_db = account.state_db
+    if state_db is None:
+        return None
+    with account.state_lock, state_db:
+        row = state_db.execute(
+            "SELECT etag, last_modified, link, body FROM http_cache WHERE url = ?",
+            (key,),
+        ).fetchone()
+        if row is not None:
+            state_db.execute(
+                "UPDATE http_cache SET used_at = ? WHERE url = ?", (time.time(), key)
+            )
+    return row
+
+
+# Caches a Canvas response that can be revalidated, then evicts the least
+# recently used entries until the cache fits in canvas_cache_max_mb
+def cache_store(account, key, response):
+    state_db = account.state_db
+    etag = response.headers.get("ETag")
+    last_modified = response.headers.get("Last-Modified")
+    if state_db is None or (etag is None and last_modified is None):
         return
-    except Exception as error:
-        print(f"Error while loading Assignments: {error}")
-        print(f"Check or regenerate API Key and Canvas URL")
-        exit()
-
-
-# Loads all user tasks from Todoist
-def load_todoist_tasks():
-    pages = todoist_api.get_tasks()
-    for page in pages:
-        for task in page:
-            todoist_tasks.append(task)
-    print(f"Loaded {len(todoist_tasks)} Todoist Tasks")
-
-
-# Loads all user projects from Todoist
-def load_todoist_projects():
-    pages = todoist_api.get_projects()
-    for page in pages:
-        for project in page:
-            todoist_project_dict[project.name] = project.id
-    print(f"Loaded {len(todoist_project_dict)} Todoist Projects")
-
-
-# Checks to see if the user has a project matching their course names, if there
-# is not a new project will be created
-def create_todoist_projects():
-    for course_id in course_ids:
-        if courses_id_name_dict[course_id] not in todoist_project_dict:
-            project = todoist_api.add_project(courses_id_name_dict[course_id])
-            print(f"Project {courses_id_name_dict[course_id]} created")
-            todoist_project_dict[project.name] = project.id
-        else:
-            print(f"Project {courses_id_name_dict[course_id]} exists")
+    max_mb = float(account.config.get("canvas_cache_max_mb", cache_max_mb))
+    body = response.content
+    with account.state_lock, state_db:
+        state_db.execute(
+            "INSERT OR REPLACE INTO http_cache VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (
+                key,
+                etag,
+                last_modified,
+                response.headers.get("Link"),
+                body,
+                len(body),
+                time.time(),
+            ),
+        )
+        total = state_db.execute("SELECT SUM(size) FROM http_cache").fetchone()[0]
+        for url, size in state_db.execute(
+            "SELECT url, size FROM http_cache ORDER BY used_at"
+        ).fetchall():
+            if total <= max_mb * 1024 * 1024:
+                break
+            state_db.execute("DELETE FROM http_cache WHERE url = ?", (url,))
+            total -= size
 
 
-# Transfers over assignments from canvas over to Todoist, the method Checks
-# to make sure the assignment has not already been transferred to prevent overlap
-def transfer_assignments_to_todoist():
-    new_added = 0
-    updated = 0
-    already_synced = 0
-    excluded = 0
-    global limit_reached
-    global throttle_number
-    request_count = 0
+def state_get(account, key, default=None):
+    row = account.state_db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+    return row[0] if row is not None else default
+
+
+def state_set(account, key, value):
+    account.state_db.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (key, value))
+
+
+# Brings the stored copy of Todoist up to date with one incremental Sync API
+# request. The first run (or an expired token) receives everything
+def sync_todoist_state(account):
+    state_db = account.state_db
+    response = todoist_request(
+        account,
+        todoist_sync,
+        account,
+        sync_token=state_get(account, "todoist_sync_token", "*"),
+        resource_types=["projects", "items"],
+    )
+    with state_db:
+        if response.get("full_sync"):
+            state_db.execute("DELETE FROM projects")
+            state_db.execute("DELETE FROM tasks")
+        for project in response.get("projects", []):
+            if project.get("is_deleted") or project.get("is_archived"):
+                state_db.execute("DELETE FROM projects WHERE id = ?", (project["id"],))
+            else:
+                state_db.execute(
+                    "INSERT OR REPLACE INTO projects VALUES (?, ?)",
+                    (project["id"], project["name"]),
+                )
+        for item in response.get("items", []):
+            account.todoist_changed_task_ids.add(item["id"])
+            if item.get("is_deleted") or item.get("checked"):
+                state_db.execute("DELETE FROM tasks WHERE id = ?", (item["id"],))
+            else:
+                state_db.execute(
+                    "INSERT OR REPLACE INTO tasks VALUES (?, ?, ?, ?, ?)",
+                    (
+                        item["id"],
+                        item["project_id"],
+                        item["content"],
+                        item.get("description", ""),
+                        json.dumps(item.get("labels", [])),
+                    ),
+                )
+        state_set(account, "todoist_sync_token", response["sync_token"])
+    account.log(
+        f"Synced {len(response.get('items', []))} changed Todoist Tasks"
+        + (" (full sync)" if response.get("full_sync") else "")
+    )
+    return len(response.get("items", [])) + len(response.get("projects", []))
+
+
+# Loads the tasks of the course projects from the state store, indexing them as
+# the rows stream in. Tasks in other projects can never match an assignment, so
+# they are left on disk. With "todoist_match_label" in the config only tasks
+# carrying that label are loaded
+def load_todoist_tasks(account):
+    project_ids = set(account.course_project_ids.values())
+    query = (
+        "SELECT id, project_id, content, description FROM tasks"
+        f" WHERE project_id IN ({', '.join('?' * len(project_ids))})"
+    )
+    params = list(project_ids)
+    label = account.config.get("todoist_match_label")
+    if label:
+        query += " AND EXISTS (SELECT 1 FROM json_each(tasks.labels) WHERE value = ?)"
+        params.append(label)
+    account.todoist_task_count = index_todoist_tasks(
+        account, (TodoistTask(*row) for row in account.state_db.execute(query, params))
+    )
+    account.log(
+        f"Loaded {account.todoist_task_count} Todoist Tasks from {len(project_ids)} course projects"
+    )
+
+
+# What a plan keeps of an assignment to record it as synced once its command is applied
+PlannedAssignment = namedtuple("PlannedAssignment", ["id", "updated_at"])
+
+
+# Records that an assignment at its current updated_at is tracked by task_id
+def record_synced_assignment(account, assignment, task_id):
+    account.state_db.execute(
+        "INSERT OR REPLACE INTO assignments VALUES (?, ?, ?)",
+        (str(assignment.id), assignment.updated_at, task_id),
+    )
+
+
+# Builds the lookup tables used to match Canvas assignments to Todoist tasks, so
+# transfer_assignments_to_todoist does not have to scan every task per assignment.
+# Returns the number of tasks indexed
+def index_todoist_tasks(account, tasks):
+    account.todoist_task_index.clear()
+    account.todoist_task_url_index.clear()
+    count = 0
+    for task in tasks:
+        index_todoist_task(account, task)
+        count += 1
+    return count
+
+
+def index_todoist_task(account, task):
+    # Keep the first task seen for a key, same as the old linear scan did
+    account.todoist_task_index.setdefault((task.project_id, task.content), task)
+    assignment_id = canvas_assignment_id(task.content)
+    if assignment_id is not None:
+        account.todoist_task_url_index.setdefault(assignment_id, task)
+
+
+# Extracts the Canvas assignment id from an assignment html_url or from task
+# content that embeds one, e.g. "[Essay](https://x/courses/1/assignments/42) Due"
+def canvas_assignment_id(text):
+    match = re.search(r"/assignments/(\d+)", text or "")
+    if match is None:
+        return None
+    return match.group(1)
+
+
+# Task content used to track an assignment in Todoist
+def task_content(assignment):
+    return f"[{assignment.name}]({assignment.html_url}) Due"
+
+
+# Returns the Todoist task already tracking this assignment, or None. Tasks are
+# matched by exact content within the course project first, then by the Canvas
+# assignment id so a renamed assignment still finds its original task
+def find_todoist_task(account, assignment, project_id):
+    task = account.todoist_task_index.get((project_id, task_content(assignment)))
+    if task is not None:
+        return task
+    task = account.todoist_task_url_index.get(
+        canvas_assignment_id(assignment.html_url)
+    )
+    if task is not None and task.project_id == project_id:
+        return task
+    return None
+
+
+# Loads all user projects from the state store and works out the project of each
+# course: the one stored by an earlier run while it still exists in Todoist (the
+# state store drops deleted and archived projects), else one named after the course
+def load_todoist_projects(account):
+    project_ids = set()
+    for project_id, name in account.state_db.execute("SELECT id, name FROM projects"):
+        account.todoist_project_dict[name] = project_id
+        project_ids.add(project_id)
+    account.log(f"Loaded {len(account.todoist_project_dict)} Todoist Projects")
+    stored = dict(account.state_db.execute("SELECT id, project_id FROM courses"))
+    matched = {}
+    for course_id in account.course_ids:
+        project_id = stored.get(str(course_id))
+        if project_id in project_ids:
+            account.course_project_ids[course_id] = project_id
+            continue
+        project_id = account.todoist_project_dict.get(account.courses_id_name_dict[course_id])
+        if project_id is not None:
+            account.course_project_ids[course_id] = project_id
+            matched[course_id] = project_id
+    store_course_projects(account, matched)
+
+
+def store_course_projects(account, course_project_ids):
+    with account.state_db:
+        account.state_db.executemany(
+            "UPDATE courses SET project_id = ? WHERE id = ?",
+            [(project_id, str(course_id)) for course_id, project_id in course_project_ids.items()],
+        )
+
+
+# Creates a project for every course that has none, all in one Sync API request.
+# While planning, the project_add commands go into the plan and tasks of the new
+# projects refer to them by temp id
+def create_todoist_projects(account):
+    courses_id_name_dict = account.courses_id_name_dict
+    todoist_queue = account.todoist_queue
+    commands = {}
+    for course_id in account.course_ids:
+        if course_id in account.course_project_ids:
+            account.log(f"Project {courses_id_name_dict[course_id]} exists")
+            continue
+        temp_id = str(uuid.uuid4())
+        commands[course_id] = todoist_queue.add(
+            "project_add", {"name": courses_id_name_dict[course_id]}, temp_id=temp_id
+        )
+        account.course_project_ids[course_id] = temp_id
+        if account.planning:
+            account.log(f"Project {courses_id_name_dict[course_id]} will be created")
+    if not commands or account.planning:
+        return
+    todoist_queue.flush()
+    created = {}
+    for course_id, command_uuid in commands.items():
+        if command_uuid not in todoist_queue.results:
+            raise SyncError(f"Could not create Todoist project {courses_id_name_dict[course_id]}")
+        created[course_id] = todoist_queue.results[command_uuid]
+        account.course_project_ids[course_id] = created[course_id]
+        account.todoist_project_dict[courses_id_name_dict[course_id]] = created[course_id]
+        account.log(f"Project {courses_id_name_dict[course_id]} created")
+    store_course_projects(account, created)
+
+
+# Submission types of assignments skipped unless sync_null_assignments is set
+ungraded_submission_types = frozenset(["not_graded", "none", "on_paper"])
+
+
+# Filter stage of the sync pipeline: drops assignments that are past due or are
+# excluded by the no due date / not graded / locked options, and yields
+# (assignment, course_name, project_id) for the rest
+def filter_assignments(account, assignments, counts):
+    config = account.config
+    sync_no_due_date = config["sync_no_due_date_assignments"]
+    sync_null = config["sync_null_assignments"]
+    sync_locked = config["sync_locked_assignments"]
+    courses_id_name_dict = account.courses_id_name_dict
+    course_project_ids = account.course_project_ids
+    # Worked out once per sync rather than once per assignment
     now_utc = datetime.now(timezone.utc)
+    unlock_cutoff = now_utc + timedelta(days=3)
     for assignment in assignments:
         # Only add assignments with a due date in the future
-        due_at_str = assignment.get("due_at")
-        due_at_dt = None
-        if due_at_str is not None:
-            try:
-                # Parse the datetime and make it timezone-aware (Canvas dates are in UTC)
-                due_at_dt = datetime.strptime(due_at_str, "%Y-%m-%dT%H:%M:%SZ")
-                due_at_dt = due_at_dt.replace(tzinfo=timezone.utc)
-                if due_at_dt <= now_utc:
-                    # Exclude assignments with due dates in the past or now
-                    continue
-            except Exception as e:
-                print(
-                    f"Skipping assignment due to invalid due_at: {assignment.get('name')} ({due_at_str}) - {e}"
-                )
+        if assignment.due_at is not None:
+            if assignment.due_at <= now_utc:
+                # Exclude assignments with due dates in the past or now
                 continue
         else:
             # If assignment has no due date, keep existing exclusion logic
-            if config["sync_no_due_date_assignments"] == False:
-                course_name = courses_id_name_dict[assignment["course_id"]]
-                print(
-                    f"Excluding assignment with no due date: {course_name}: {assignment['name']}"
+            if sync_no_due_date == False:
+                course_name = courses_id_name_dict[assignment.course_id]
+                account.log(
+                    f"Excluding assignment with no due date: {course_name}: {assignment.name}"
+                )
+                counts["excluded"] += 1
+                continue
+
+        course_name = courses_id_name_dict[assignment.course_id]
+        project_id = course_project_ids[assignment.course_id]
+
+        # Handle case where assignment is not graded
+        if sync_null == False:
+            ## This is hacky, but it works for now - need to fix this
+            if assignment.submission_type in ungraded_submission_types:
+                account.log(
+                    f"Excluding ungraded/non-submittable assignment: {course_name}: {assignment.name}"
                 )
-                excluded += 1
+                counts["excluded"] += 1
                 continue
+        # Handle case where assignment is locked and unlock date is more than 2 days in the future
+        if (
+            assignment.unlock_at is not None
+            and sync_locked == False
+            and assignment.unlock_at > unlock_cutoff
+        ):
+            # Remember when it comes within reach, so a quick check knows to sync then
+            unlock_due = assignment.unlock_at - timedelta(days=3)
+            if account.next_unlock is None or unlock_due < account.next_unlock:
+                account.next_unlock = unlock_due
+            account.log(
+                f"Excluding assignment that is not yet unlocked: {course_name}: {assignment.name}: {assignment.lock_explanation}"
+            )
+            counts["excluded"] += 1
+            continue
+        # Handle case where assignment is locked and unlock date is empty
+        if (
+            assignment.locked_for_user == True
+            and assignment.unlock_at is None
+            and sync_locked == False
+        ):
+            account.log(
+                f"Excluding assignment that is locked: {course_name}: {assignment.name}: {assignment.lock_explanation}"
+            )
+            counts["excluded"] += 1
+            continue
 
-        course_name = courses_id_name_dict[assignment["course_id"]]
-        project_id = todoist_project_dict[course_name]
+        yield assignment, course_name, project_id
+
+
+# Transfers over assignments from canvas over to Todoist as they stream in, the
+# method Checks to make sure the assignment has not already been transferred to
+# prevent overlap
+def transfer_assignments_to_todoist(account, assignments):
+    added_uuids = []  # Commands of the tasks added and updated, counted once confirmed
+    updated_uuids = []
+    already_synced = 0
+    counts = Counter()
+    todoist_queue = account.todoist_queue
+    state_db = account.state_db
+    # Assignment id -> (updated_at, task_id) recorded on earlier runs
+    synced_assignments = {
+        row[0]: row[1:]
+        for row in state_db.execute("SELECT id, updated_at, task_id FROM assignments")
+    }
+    # Open tasks tracking a synced assignment, wherever the user has moved them
+    task_ids = {
+        row[0]
+        for row in state_db.execute(
+            "SELECT tasks.id FROM tasks JOIN assignments ON tasks.id = assignments.task_id"
+        )
+    }
+    queued = todoist_queue.assignments
+    # Matched tasks that needed no change, recorded once the course loads have
+    # finished writing to the state store
+    unchanged = []
+    for assignment, course_name, project_id in filter_assignments(
+        account, assignments, counts
+    ):
+        # Skip the diff for assignments unchanged in Canvas since the last run whose
+        # task is also unchanged in Todoist
+        synced = synced_assignments.get(str(assignment.id))
+        if (
+            synced is not None
+            and synced[0] == assignment.updated_at
+            and synced[1] in task_ids
+            and synced[1] not in account.todoist_changed_task_ids
+        ):
+            already_synced += 1
+            continue
 
-        is_added = False
+        # Check if assignment is already added to Todoist within the same Project
+        task = find_todoist_task(account, assignment, project_id)
+        is_added = task is not None
         is_synced = True
 
-        for task in todoist_tasks:
-            # Check if assignment is already added to Todoist with same name and within the same Project
-            task_content = f"[{assignment['name']}]({assignment['html_url']}) Due"
-            is_match = (task.project_id == project_id) and (
-                task.content == task_content
+        if is_added:
+            needs_update = False
+            has_description = (
+                hasattr(task, "description")
+                and task.description is not None
+                and task.description != ""
             )
 
-            if is_match:
-                is_added = True
-                needs_update = False
-                has_description = (
-                    hasattr(task, "description")
-                    and task.description is not None
-                    and task.description != ""
+            # Assignment was renamed in Canvas, matched through its assignment id
+            if task.content != task_content(assignment):
+                needs_update = True
+                is_synced = False
+                account.log(
+                    f"Canvas assignment renamed, will update: {course_name}:{assignment.name}"
                 )
-
-                # Check if task doesn't have a description field (old tasks)
-                # Always update old tasks to add description
-                if not has_description:
+            # Check if task doesn't have a description field (old tasks)
+            # Always update old tasks to add description
+            elif not has_description:
+                needs_update = True
+                is_synced = False
+                account.log(
+                    f"Old task found without description, will update: {course_name}:{assignment.name}"
+                )
+            # If task has a description, check if Canvas due date changed and update description
+            else:
+                # Check if the Canvas due date changed compared to what's in the description
+                # Only update description if the due date information changed
+                new_description = format_task_description(assignment.due_at)
+                if task.description != new_description:
                     needs_update = True
                     is_synced = False
-                    print(
-                        f"Old task found without description, will update: {course_name}:{assignment['name']}"
-                    )
-                # If task has a description, check if Canvas due date changed and update description
-                elif has_description:
-                    # Check if the Canvas due date changed compared to what's in the description
-                    # Only update description if the due date information changed
-                    new_description = format_task_description(due_at_dt)
-                    if task.description != new_description:
-                        needs_update = True
-                        is_synced = False
-                        print(
-                            f"Canvas due date changed for: {course_name}:{assignment['name']}, updating description"
-                        )
-
-                # Update task if needed (only updates description, not the actual due date)
-                if needs_update:
-                    print(
-                        f"Updating assignment description: {course_name}:{assignment['name']} to '{format_task_description(due_at_dt)}'"
+                    account.log(
+                        f"Canvas due date changed for: {course_name}:{assignment.name}, updating description"
                     )
-                    update_task(assignment, task)
-                    request_count += 1
 
-                break
-
-            # Handle case where assignment is not graded
-            if config["sync_null_assignments"] == False:
-                ## This is hacky, but it works for now - need to fix this
-                if (
-                    assignment["submission_types"][0] == "not_graded"
-                    or assignment["submission_types"][0] == "none"
-                    or assignment["submission_types"][0] == "on_paper"
-                ):
-                    print(
-                        f"Excluding ungraded/non-submittable assignment: {course_name}: {assignment['name']}"
-                    )
-                    is_added = True
-                    excluded += 1
-                    break
-            # Handle case where assignment is locked and unlock date is more than 2 days in the future
-            if (
-                assignment["unlock_at"] is not None
-                and config["sync_locked_assignments"] == False
-                and assignment["unlock_at"]
-                > (datetime.now() + timedelta(days=3)).isoformat()
-            ):
-                print(
-                    f"Excluding assignment that is not yet unlocked: {course_name}: {assignment['name']}: {assignment['lock_explanation']}"
+            # Update task if needed (only updates description and name, not the actual due date)
+            if needs_update:
+                account.log(
+                    f"Updating assignment description: {course_name}:{assignment.name} to '{format_task_description(assignment.due_at)}'"
                 )
-                is_added = True
-                excluded += 1
-                break
-            # Handle case where assignment is locked and unlock date is empty
-            if (
-                assignment["locked_for_user"] == True
-                and assignment["unlock_at"] is None
-                and config["sync_locked_assignments"] == False
-            ):
-                print(
-                    f"Excluding assignment that is locked: {course_name}: {assignment['name']}: {assignment['lock_explanation']}"
-                )
-                is_added = True
-                excluded += 1
-                break
+                updated_uuids.append(update_task(account, assignment, task))
+            else:
+                unchanged.append((assignment, task.id))
+
         # Add assignment to Todoist if not already added - Ignore assignments that are already submitted
         if not is_added:
-            if assignment["submission"]["workflow_state"] == "unsubmitted":
-                print(f"Adding assignment {course_name}: {assignment['name']}")
-                add_new_task(assignment, project_id)
-                new_added += 1
-                request_count += 1
-        # Update count of updated assignments (updated due date - already updated in Todoist)
-        if is_added and not is_synced:
-            updated += 1
+            if assignment.workflow_state == "unsubmitted":
+                account.log(f"Adding assignment {course_name}: {assignment.name}")
+                added_uuids.append(add_new_task(account, assignment, project_id))
         # Update count of already synced assignments (already synced to Todoist, no updates)
         if is_synced and is_added:
             already_synced += 1
-        if new_added > max_added:
-            limit_reached = True
-        if limit_reached:
-            break
-        # Throttle requests to Todoist API to prevent rate limiting, sleep every 50 requests
-        if request_count % throttle_number == 0 and request_count > 1:
-            print(f"Current request count: {request_count}")
-            sleep()
-    if limit_reached:
-        print(
-            f"Reached Todoist API or configured limit. Not all tasks added. Please try again in 15 minutes."
+    # Send every queued add and update in as few Sync API requests as possible
+    if not todoist_queue.flush():
+        account.limit_reached = True
+    with state_db:
+        for assignment, task_id in unchanged:
+            record_synced_assignment(account, assignment, task_id)
+        for command_uuid, assignment in queued.items():
+            if command_uuid in todoist_queue.results:
+                record_synced_assignment(
+                    account, assignment, todoist_queue.results[command_uuid]
+                )
+    # A plan only queues the commands, so its counts are what apply will send
+    if not account.planning:
+        added_uuids = [each for each in added_uuids if each in todoist_queue.results]
+        updated_uuids = [each for each in updated_uuids if each in todoist_queue.results]
+    new_added = len(added_uuids)
+    updated = len(updated_uuids)
+    if account.limit_reached:
+        account.log(
+            f"Todoist did not accept {len(todoist_queue.failed)} changes. Not all tasks synced. Please try again later."
         )
-    print(f"  {'-'*52}")
-    print(f"Added to Todoist: {new_added}")
-    print(f"Due Date Updated In Todoist: {updated}")
-    print(f"Already Synced to Todoist: {already_synced}")
-    print(f"Excluded: {excluded}")
+        errors = Counter(str(error) for error in todoist_queue.failed.values())
+        for error, count in errors.most_common():
+            account.log(f"  {count} x {error}")
+    account.log(f"  {'-'*52}")
+    account.log(f"Added to Todoist: {new_added}")
+    account.log(f"Due Date Updated In Todoist: {updated}")
+    account.log(f"Already Synced to Todoist: {already_synced}")
+    account.log(f"Excluded: {counts['excluded']}")
+    account.log(f"Todoist Sync Requests: {todoist_queue.requests}")
+    account.log(
+        f"Time Spent Throttled: {sum(account.metrics.throttled().values()):.1f} seconds"
+    )
+    account.metrics.results.update(
+        added=new_added,
+        updated=updated,
+        already_synced=already_synced,
+        excluded=counts["excluded"],
+        failed=len(todoist_queue.failed),
+    )
+
 
+# Ids of the assignments a sync downloaded, and of those the user has submitted,
+# tallied as they stream past like AssignmentStats
+class SeenAssignments:
+    def __init__(self):
+        self.ids = set()
+        self.submitted = set()
+
+    def recorded(self, assignments):
+        for assignment in assignments:
+            self.ids.add(str(assignment.id))
+            if assignment.workflow_state != "unsubmitted":
+                self.submitted.add(str(assignment.id))
+            yield assignment
+
+
+# Closes the open tasks of synced assignments that are no longer outstanding, so
+# the tasks loaded and matched every sync stay proportional to the work left.
+# Tasks are found by assignment id through the assignments table, which follows
+# them through renames. An assignment is stale once submitted, or, after a sync
+# that downloaded every assignment of every course, once it is gone from Canvas.
+# The item_close commands go out in batches; "close_stale_tasks": false in the
+# config turns this off
+def reconcile_todoist_tasks(account, seen, complete):
+    if not account.config.get("close_stale_tasks", True):
+        return
+    complete = complete and not account.canvas_incomplete
+    project_ids = list(set(account.course_project_ids.values()))
+    rows = account.state_db.execute(
+        "SELECT assignments.id, assignments.task_id FROM assignments"
+        " JOIN tasks ON tasks.id = assignments.task_id"
+        f" WHERE tasks.project_id IN ({', '.join('?' * len(project_ids))})",
+        project_ids,
+    ).fetchall()
+    todoist_queue = account.todoist_queue
+    stale = {}
+    for assignment_id, task_id in rows:
+        if assignment_id in seen.submitted or (complete and assignment_id not in seen.ids):
+            stale[todoist_queue.add("item_close", {"id": task_id})] = assignment_id
+    if not stale or account.planning:
+        return
+    todoist_queue.flush()
+    closed = [
+        assignment_id
+        for command_uuid, assignment_id in stale.items()
+        if command_uuid in todoist_queue.results
+    ]
+    with account.state_db:
+        account.state_db.executemany(
+            "DELETE FROM assignments WHERE id = ?", [(assignment_id,) for assignment_id in closed]
+        )
+    account.log(f"Closed {len(closed)} Todoist Tasks of submitted or deleted assignments")
+    account.metrics.results["closed"] = len(closed)
 
-# Helper function to format task description with due date
+
+# Helper function to format task description with due date. Assignments share
+# due times, and each is described more than once per sync, so results are cached
+@lru_cache(maxsize=4096)
 def format_task_description(due_dt=None):
     if due_dt is not None:
         # Convert UTC to Mountain Time (automatically handles MST/MDT)
-        mountain_time = ZoneInfo("America/Phoenix")
         mt_dt = due_dt.astimezone(mountain_time)
         # Use %Z to show the actual timezone (MST or MDT)
         due_str = mt_dt.strftime("%b %d, %Y at %I:%M %p %Z")
@@ -425,107 +1910,446 @@ def format_task_description(due_dt=None):
 
 # Adds a new task from a Canvas assignment object to Todoist under the
 # project corresponding to project_id
-def add_new_task(assignment, project_id):
-    global limit_reached
-    try:
-        due_datetime = None
-        due_date = None
-        due_dt = None
-        if assignment["due_at"]:
-            due_dt = datetime.strptime(assignment["due_at"], "%Y-%m-%dT%H:%M:%SZ")
-            due_dt = due_dt.replace(tzinfo=timezone.utc)
-
-            # If due time is 11:59pm, set as all-day (no time)
-            if due_dt.hour == 6 and due_dt.minute == 59:
-                due_date = due_dt.date() - timedelta(days=1)
+def add_new_task(account, assignment, project_id):
+    due = None
+    due_dt = assignment.due_at
+    if due_dt is not None:
+        # If due time is 11:59pm, set as all-day (no time)
+        if due_dt.hour == 6 and due_dt.minute == 59:
+            due = {"date": (due_dt.date() - timedelta(days=1)).isoformat()}
+        else:
+            due = {"date": due_dt.strftime("%Y-%m-%dT%H:%M:%SZ")}
+
+    # Queue the task with content (without due date) and description (with due date)
+    return account.todoist_queue.add(
+        "item_add",
+        {
+            "content": task_content(assignment),
+            "description": format_task_description(due_dt),
+            "project_id": project_id,
+            "due": due,
+            "labels": task_labels(account),
+            "priority": 4,
+        },
+        temp_id=str(uuid.uuid4()),
+        assignment=assignment,
+    )
+
+
+# Labels of new tasks, including the match label so later syncs find them
+def task_labels(account):
+    labels = list(account.config["todoist_task_labels"])
+    label = account.config.get("todoist_match_label")
+    if label and label not in labels:
+        labels.append(label)
+    return labels
+
+
+# Running Canvas assignment statistics, tallied as assignments stream past so the
+# sync never has to keep every assignment around for the report at the end
+class AssignmentStats:
+    def __init__(self):
+        self.total = 0
+        self.graded = 0
+        self.latest_graded = None
+        self.submitted = 0
+        self.ignored_not_graded = 0
+        self.ignored_no_submission = 0
+        self.locked = 0
+        self.instructor_graded = 0
+        self.courses = None  # Course ids counted, set on the stored statistics
+        self.counted_at = None  # When the stored statistics were counted
+
+    # The statistics as kept in the state store between full downloads
+    def to_json(self, account):
+        counts = dict(vars(self))
+        if self.latest_graded is not None:
+            counts["latest_graded"] = self.latest_graded.strftime("%Y-%m-%dT%H:%M:%SZ")
+        counts["courses"] = sorted(map(str, account.course_ids))
+        counts["counted_at"] = datetime.now(timezone.utc).isoformat()
+        return json.dumps(counts)
+
+    @classmethod
+    def from_json(cls, text):
+        stats = cls()
+        vars(stats).update(json.loads(text))
+        stats.latest_graded = parse_canvas_time(stats.latest_graded)
+        stats.counted_at = datetime.fromisoformat(stats.counted_at)
+        return stats
+
+    # Passes assignments through unchanged while counting them
+    def counted(self, assignments):
+        for assignment in assignments:
+            self.count(assignment)
+            yield assignment
+
+    def count(self, assignment):
+        self.total += 1
+        # Check for assignment graded_at dates, and if graded_at is not None, keep the most recent grade update
+        timestamp = assignment.graded_at
+        if timestamp is not None:
+            self.graded += 1
+            if self.latest_graded is None or timestamp > self.latest_graded:
+                self.latest_graded = timestamp
+        if assignment.graded_submissions_exist == True:
+            self.instructor_graded += 1
+        if assignment.workflow_state != "unsubmitted":
+            self.submitted += 1
+        elif assignment.locked_for_user == True:
+            self.locked += 1
+        elif assignment.submission_type == "none":
+            self.ignored_no_submission += 1
+        elif assignment.submission_type == "not_graded":
+            self.ignored_not_graded += 1
+
+
+def canvas_assignment_stats(account, stats):
+    account.log(f"  {'-'*52}")
+    account.log(" #     Current Canvas Assignment Statistics     #")
+    if stats.counted_at is not None:
+        account.log(f"Counted At: {aslocaltimestr(stats.counted_at)}")
+    account.log(f"Total Assignments: {stats.total}")
+    account.log(f"Total Submitted: {stats.submitted}")
+    account.log(f"Total Locked: {stats.locked}")
+    account.log(f"Total Unsubmittable: {stats.ignored_no_submission}")
+    account.log(f"Total Not_Graded: {stats.ignored_not_graded}")
+    account.log(
+        f"Remaining (unlocked) Assignments: {(stats.total-stats.submitted-stats.ignored_not_graded-stats.ignored_no_submission-stats.locked)}"
+    )
+    account.log(f"\n Grading Statistics:")
+    account.log(f"Total Currently Graded: {max(stats.instructor_graded,stats.graded)}")
+    if stats.latest_graded is None:
+        account.log(f"Last Grade Update: Never")
+    else:
+        account.log(f"Last Grade Update: {aslocaltimestr(stats.latest_graded)}")
+
+
+# Queues an update of an existing task from its Canvas assignment
+def update_task(account, assignment, task):
+    due_dt = assignment.due_at
+
+    # Update ONLY the description with the new due date (and the content if the
+    # assignment was renamed). Do NOT update due_datetime or due_date fields to
+    # allow user customization
+    args = {"id": task.id, "description": format_task_description(due_dt)}
+    content = task_content(assignment)
+    if content != task.content:
+        args["content"] = content
+    return account.todoist_queue.add("item_update", args, assignment=assignment)
+
+
+# Collects Todoist write commands and sends them through the Sync API in batches
+# of up to sync_batch_size. Commands that fail with a retryable error are sent
+# again (with the same uuid, so Todoist never applies one twice); the rest are
+# kept in failed. Results map each command uuid to the id of the created or
+# updated object. Todoist only resolves a temp id within the request that
+# created it, so later requests get the real id instead
+class TodoistCommandQueue:
+    def __init__(self, account, batch_size=sync_batch_size):
+        self.account = account
+        self.batch_size = batch_size
+        self.pending = []
+        self.assignments = {}  # Command uuid -> assignment, recorded once the command succeeds
+        self.attempts = {}
+        self.results = {}
+        self.failed = {}
+        self.temp_ids = {}  # Temp id -> real id of objects created by confirmed commands
+        self.requests = 0
+        self.journaled = set()  # Uuids of the commands already in the journal
+
+    def add(self, command_type, args, temp_id=None, assignment=None):
+        command = {"type": command_type, "uuid": str(uuid.uuid4()), "args": args}
+        if temp_id is not None:
+            command["temp_id"] = temp_id
+        # Registered before a flush can journal the command
+        if assignment is not None:
+            self.assignments[command["uuid"]] = assignment
+        self.pending.append(command)
+        # Start writing as soon as a full batch is ready instead of at the end
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+        return command["uuid"]
+
+    def flush(self):
+        while self.pending:
+            batch = self.pending[: self.batch_size]
+            del self.pending[: self.batch_size]
+            for command in batch:
+                for key in ("id", "project_id"):
+                    if command["args"].get(key) in self.temp_ids:
+                        command["args"][key] = self.temp_ids[command["args"][key]]
+            journal_intents(
+                self.account,
+                [command for command in batch if command["uuid"] not in self.journaled],
+                self.assignments,
+            )
+            self.journaled.update(command["uuid"] for command in batch)
+            try:
+                response = todoist_request(
+                    self.account, todoist_sync, self.account, commands=batch
+                )
+            except Exception as error:
+                self.account.log(f"Error while sending {len(batch)} Todoist commands: {error}")
+                for command in batch:
+                    self.failed[command["uuid"]] = str(error)
+                continue
+            self.requests += 1
+            self._collect(batch, response)
+        return not self.failed
+
+    def _collect(self, batch, response):
+        statuses = response.get("sync_status", {})
+        temp_ids = response.get("temp_id_mapping", {})
+        outcomes = []
+        retry_attempt = 0
+        retried_temp_ids = set()  # Objects whose creation is sent again
+        for command in batch:
+            status = statuses.get(command["uuid"])
+            if status == "ok":
+                temp_id = command.get("temp_id")
+                self.results[command["uuid"]] = temp_ids.get(
+                    temp_id, command["args"].get("id")
+                )
+                if temp_id is not None:
+                    self.temp_ids[temp_id] = self.results[command["uuid"]]
+                outcomes.append((command["uuid"], "confirmed", self.results[command["uuid"]]))
+                continue
+            attempt = self.attempts.get(command["uuid"], 0) + 1
+            self.attempts[command["uuid"]] = attempt
+            http_code = status.get("http_code", 0) if isinstance(status, dict) else 0
+            retryable = status is None or http_code == 429 or http_code >= 500
+            # A command referring to an object whose creation failed is sent
+            # again with it, whatever Todoist said about the missing object
+            retryable = retryable or any(
+                command["args"].get(key) in retried_temp_ids for key in ("id", "project_id")
+            )
+            if retryable and attempt <= max_retries:
+                self.pending.append(command)
+                retry_attempt = max(retry_attempt, attempt)
+                if command.get("temp_id") is not None:
+                    retried_temp_ids.add(command["temp_id"])
             else:
-                due_datetime = aslocaltimestr(due_dt)
-
-        # Create task content (without due date)
-        content = f"[{assignment['name']}]({assignment['html_url']}) Due"
-        # Create task description (with due date)
-        description = format_task_description(due_dt)
-
-        todoist_api.add_task(
-            content=content,
-            description=description,
-            project_id=project_id,
-            due_datetime=due_datetime,
-            due_date=due_date,
-            labels=config["todoist_task_labels"],
-            priority=4,
+                self.account.log(f"Todoist rejected {command['type']}: {status}")
+                self.failed[command["uuid"]] = status
+                if not retryable_failure(status):
+                    # Left pending otherwise, for the next run to replay
+                    outcomes.append((command["uuid"], "failed", json.dumps(status)))
+        journal_outcomes(self.account, outcomes)
+        if retry_attempt:
+            # Throttled or failed commands are sent again once the delay has passed
+            self.account.todoist_limiter.back_off(retry_delay(retry_attempt))
+
+
+# The journal in the state store is an append-only record of Todoist commands:
+# an intent row is written before a command is sent, and a confirmed or failed row
+# once Todoist has answered for it. Intents without an answer are commands an
+# interrupted run may or may not have delivered; replay_journal sends them again
+def journal_intents(account, commands, assignments):
+    state_db = account.state_db
+    if state_db is None or not commands:
+        return
+    rows = []
+    for command in commands:
+        assignment = assignments.get(command["uuid"])
+        rows.append(
+            (
+                command["uuid"],
+                json.dumps(command),
+                json.dumps([assignment.id, assignment.updated_at]) if assignment else None,
+            )
         )
-    except Exception as error:
-        print(
-            f"Error while adding task: {error}, likely due to rate limiting. Try again in 15 minutes"
+    # Course loads write the HTTP cache on the same connection meanwhile
+    with account.state_lock, state_db:
+        state_db.executemany(
+            "INSERT INTO journal (uuid, kind, command, assignment) VALUES (?, 'intent', ?, ?)",
+            rows,
         )
-        limit_reached = True
-
-
-def canvas_assignment_stats():
-    print(f"  {'-'*52}")
-    print(" #     Current Canvas Assignment Statistics     #")
-    print(f"Total Assignments: {len(assignments)}")
-    graded_timestamps = []
-    submitted = 0
-    ignored_not_graded = 0
-    ignored_no_submission = 0
-    locked = 0
-    instructor_graded = 0
-    for assignment in assignments:
-        # Check for assignment graded_at dates, and if graded_at is not None, add to graded_timestamps list to report most recent grade update
-        if assignment["submission"]["graded_at"] is not None:
-            timestamp = datetime.strptime(
-                (assignment["submission"]["graded_at"]), "%Y-%m-%dT%H:%M:%SZ"
+
+
+def journal_outcomes(account, outcomes):
+    state_db = account.state_db
+    if state_db is None or not outcomes:
+        return
+    with account.state_lock, state_db:
+        state_db.executemany(
+            "INSERT INTO journal (uuid, kind, result) VALUES (?, ?, ?)", outcomes
+        )
+
+
+# Intents in the journal that never got an answer, oldest first
+def pending_journal(account):
+    return account.state_db.execute(
+        "SELECT command, assignment FROM journal AS intent WHERE kind = 'intent'"
+        " AND NOT EXISTS (SELECT 1 FROM journal WHERE uuid = intent.uuid AND kind != 'intent')"
+        " ORDER BY seq"
+    ).fetchall()
+
+
+# Sends the commands an interrupted run left unanswered, before the sync reads
+# Todoist, so the tasks they create are seen by the diff instead of being added
+# again. They keep their uuids, so Todoist applies any that did land only once.
+# Assignments of replayed commands are recorded as synced, and answered entries
+# are dropped from the journal, keeping it as small as the pending work. If some
+# are still unanswered the sync stops: diffing now would add their tasks a second
+# time under new uuids
+def replay_journal(account):
+    state_db = account.state_db
+    pending = pending_journal(account)
+    unconfirmed = []
+    if pending:
+        account.log(f"Replaying {len(pending)} unconfirmed Todoist changes from an earlier run")
+        todoist_queue = account.todoist_queue
+        # Objects the interrupted run did create are referred to by their real id
+        todoist_queue.temp_ids.update(
+            state_db.execute(
+                "SELECT json_extract(intent.command, '$.temp_id'), outcome.result"
+                " FROM journal AS intent JOIN journal AS outcome ON outcome.uuid = intent.uuid"
+                " WHERE intent.kind = 'intent' AND outcome.kind = 'confirmed'"
+                " AND json_extract(intent.command, '$.temp_id') IS NOT NULL"
             )
-            timestamp = timestamp.replace(tzinfo=timezone.utc)
-            graded_timestamps.append(timestamp)
-        if assignment["graded_submissions_exist"] == True:
-            instructor_graded += 1
-        if assignment["submission"]["workflow_state"] != "unsubmitted":
-            submitted += 1
-        elif assignment["locked_for_user"] == True:
-            locked += 1
-        elif assignment["submission_types"][0] == "none":
-            ignored_no_submission += 1
-        elif assignment["submission_types"][0] == "not_graded":
-            ignored_not_graded += 1
-
-    print(f"Total Submitted: {submitted}")
-    print(f"Total Locked: {locked}")
-    print(f"Total Unsubmittable: {ignored_no_submission}")
-    print(f"Total Not_Graded: {ignored_not_graded}")
-    print(
-        f"Remaining (unlocked) Assignments: {(len(assignments)-submitted-ignored_not_graded-ignored_no_submission-locked)}"
+        )
+        replayed = {}
+        for command, assignment in pending:
+            command = json.loads(command)
+            todoist_queue.journaled.add(command["uuid"])
+            todoist_queue.pending.append(command)
+            replayed[command["uuid"]] = assignment and PlannedAssignment(*json.loads(assignment))
+        todoist_queue.flush()
+        with state_db:
+            for command_uuid, assignment in replayed.items():
+                result = todoist_queue.results.get(command_uuid)
+                status = todoist_queue.failed.pop(command_uuid, None)
+                if result is not None and assignment is not None:
+                    record_synced_assignment(account, assignment, result)
+                elif command_uuid not in todoist_queue.results and retryable_failure(status):
+                    unconfirmed.append(command_uuid)
+    with state_db:
+        state_db.execute(
+            "DELETE FROM journal WHERE uuid IN (SELECT uuid FROM journal WHERE kind != 'intent')"
+        )
+    if unconfirmed:
+        raise SyncError(
+            f"{len(unconfirmed)} Todoist changes from an earlier run are still unconfirmed; try again later"
+        )
+
+
+# Stands in for TodoistCommandQueue while planning: commands are only collected,
+# for save_plan to write out and apply_plan to send later
+class PlannedCommandQueue(TodoistCommandQueue):
+    def flush(self):
+        return True
+
+
+# Writes the commands a planning sync collected to path. Each command keeps its
+# uuid, so Todoist ignores it if a resumed apply sends it a second time
+def save_plan(account, path):
+    queue = account.todoist_queue
+    plan = {
+        "created": datetime.now(timezone.utc).isoformat(),
+        "commands": queue.pending,
+        "assignments": {
+            command_uuid: [assignment.id, assignment.updated_at]
+            for command_uuid, assignment in queue.assignments.items()
+        },
+        "temp_ids": {},  # Temp id -> real id of objects created by applied commands
+    }
+    write_plan(plan, path)
+    kinds = Counter(command["type"] for command in queue.pending)
+    account.log(
+        f"Planned {len(queue.pending)} Todoist changes ({kinds['item_add']} new tasks, "
+        f"{kinds['item_update']} updates, {kinds['item_close']} closed tasks, "
+        f"{kinds['project_add']} new projects) in {path}"
     )
-    print(f"\n Grading Statistics:")
-    print(f"Total Currently Graded: {max(instructor_graded,len(graded_timestamps))}")
-    latest_update = max(graded_timestamps, default=0)
-    if latest_update == 0:
-        print(f"Last Grade Update: Never")
-    else:
-        print(f"Last Grade Update: {aslocaltimestr(latest_update)}")
+    if queue.pending:
+        account.log("Nothing was sent to Todoist yet; run 'python easy_run.py apply' to send them")
+
+
+def write_plan(plan, path):
+    with open(path + ".tmp", "w") as plan_file:
+        json.dump(plan, plan_file, separators=(",", ":"))
+    os.replace(path + ".tmp", path)
 
 
-def update_task(assignment, task):
-    global limit_reached
+# Sends the commands of a saved plan batch by batch. After every batch the plan
+# file is rewritten without the commands that went through, so a crash or an
+# exhausted quota only loses the batch in flight, and running apply again picks
+# up from there. Returns whether the whole plan was applied
+def apply_plan(account, path, rate=None):
     try:
-        due_dt = None
-        if assignment["due_at"]:
-            due_dt = datetime.strptime(assignment["due_at"], "%Y-%m-%dT%H:%M:%SZ")
-            due_dt = due_dt.replace(tzinfo=timezone.utc)
-
-        # Update ONLY the description with the new due date
-        # Do NOT update due_datetime or due_date fields to allow user customization
-        description = format_task_description(due_dt)
-
-        todoist_api.update_task(
-            task_id=task.id,
-            description=description,
-        )
-    except Exception as error:
-        print(f"Error while updating task: {error}")
-        limit_reached = True
+        with open(path) as plan_file:
+            plan = json.load(plan_file)
+    except FileNotFoundError:
+        account.log(f"No plan found at {path}; run 'python easy_run.py plan' first")
+        return False
+    if not plan["commands"]:
+        account.log("The plan has already been applied")
+        return True
+    initialize_api(account)
+    open_state(account)
+    if rate:
+        account.todoist_limiter.rate = rate / 60
+        account.todoist_limiter.burst = account.todoist_limiter.tokens = 1
+    queue = account.todoist_queue
+    # Objects created by earlier batches are referred to by their real id; the
+    # queue adds to the plan's mapping as commands go through
+    queue.temp_ids = plan["temp_ids"]
+    total = len(plan["commands"])
+    account.log(f"Applying {total} Todoist changes from {path}")
+    while plan["commands"]:
+        batch = plan["commands"][:sync_batch_size]
+        queue.pending = list(batch)
+        queue.failed.clear()
+        queue.flush()
+        remaining = []
+        with account.state_db:
+            for command in batch:
+                result = queue.results.get(command["uuid"])
+                if result is None:
+                    if command["uuid"] in queue.failed and not retryable_failure(
+                        queue.failed[command["uuid"]]
+                    ):
+                        # Retrying cannot help, e.g. the task was deleted since planning
+                        plan["assignments"].pop(command["uuid"], None)
+                        continue
+                    remaining.append(command)
+                    continue
+                assignment = plan["assignments"].pop(command["uuid"], None)
+                if assignment is not None:
+                    record_synced_assignment(account, PlannedAssignment(*assignment), result)
+        plan["commands"] = remaining + plan["commands"][len(batch) :]
+        write_plan(plan, path)
+        if remaining:
+            account.log(
+                f"Stopped with {len(plan['commands'])} of {total} changes left; run apply again to resume"
+            )
+            return False
+    account.log(f"Applied {total} Todoist changes in {queue.requests} Sync API requests")
+    return True
+
+
+# Whether a failed Sync API command might still go through on a later attempt
+def retryable_failure(status):
+    if not isinstance(status, dict):
+        return True  # The request itself failed, e.g. a network error or 429s after every retry
+    http_code = status.get("http_code", 0)
+    return http_code == 429 or http_code >= 500
+
+
+# Sends one request to the Todoist Sync API and returns the decoded response.
+# Lists and dicts (commands, resource_types) are sent as JSON, strings such as
+# the sync token as they are
+def todoist_sync(account, **data):
+    response = account.todoist_session.post(
+        todoist_sync_url,
+        headers=account.todoist_header,
+        timeout=request_timeout,
+        data={
+            key: json.dumps(value) if isinstance(value, (list, dict)) else value
+            for key, value in data.items()
+        },
+    )
+    response.raise_for_status()
+    return response.json()
 
 
 # Credit to https://stackoverflow.com/questions/4563272/how-to-convert-a-utc-datetime-to-a-local-datetime-using-only-standard-library
@@ -557,13 +2381,350 @@ def aslocaltimestr(utc_dt):
     return utc_to_local(utc_dt)
 
 
-# Function for throttling/sleeping
-def sleep():
-    delay = (
-        randint(100, sleep_delay_max) / 1000
-    )  # random delay for throttling/rate limiting
-    print(f"Sleeping for {delay} seconds...")
-    time.sleep(delay)
+# Token bucket shared by every thread talking to one API. Tokens refill at rate
+# per second up to burst; acquire() blocks only when the bucket is empty or the
+# server told us to back off. throttled keeps the wall-clock time during which at
+# least one thread was blocked, so concurrent waits are not counted twice
+class RateLimiter:
+    def __init__(self, name, rate, burst, log=print):
+        self.name = name
+        self.log = log
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.throttled = 0.0
+        self.waiting = 0  # Threads blocked in acquire()
+        self.waiting_since = 0.0
+        self.in_flight = 0.0
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, cost=1):
+        blocked = False
+        try:
+            while True:
+                with self.lock:
+                    now = time.monotonic()
+                    self._refill(now)
+                    wait = self.blocked_until - now
+                    if wait <= 0:
+                        if self.tokens >= cost:
+                            self.tokens -= cost
+                            self.in_flight += cost
+                            return
+                        wait = (cost - self.tokens) / self.rate
+                    if not blocked:
+                        blocked = True
+                        if self.waiting == 0:
+                            self.waiting_since = now
+                        self.waiting += 1
+                time.sleep(wait)
+        finally:
+            if blocked:
+                with self.lock:
+                    self.waiting -= 1
+                    if self.waiting == 0:
+                        self.throttled += time.monotonic() - self.waiting_since
+
+    # Marks a request acquired with cost as answered. If the server reported its
+    # remaining headroom, that replaces the local estimate, minus whatever other
+    # requests are still in flight and not yet counted by the server. Otherwise
+    # the actual cost, if reported, refunds or charges the difference to cost
+    def settle(self, cost=1, remaining=None, actual=None):
+        with self.lock:
+            self.in_flight = max(0.0, self.in_flight - cost)
+            if remaining is not None:
+                self._refill(time.monotonic())
+                self.tokens = min(self.burst, remaining - self.in_flight)
+            elif actual is not None:
+                self._refill(time.monotonic())
+                self.tokens = min(self.burst, self.tokens + cost - actual)
+
+    # Block every caller for at least delay seconds
+    def back_off(self, delay):
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + delay)
+        self.log(f"{self.name} rate limit hit, backing off for {delay:.1f} seconds...")
+
+
+# Instrumentation of one sync pass of an account: how long each phase took, HTTP
+# requests by service, endpoint and status, a latency histogram per endpoint and
+# the time the rate limiters spent waiting
+class Metrics:
+    def __init__(self, account):
+        self.account = account
+        self.started = datetime.now(timezone.utc)
+        self.result = None  # "ok" or "failed" once the pass is over
+        self.spans = {}  # Phase -> seconds
+        self.requests = Counter()  # (service, endpoint, status) -> requests
+        # (service, endpoint) -> [count per bucket..., count above the last bucket, count, sum]
+        self.latency = {}
+        self.results = {}  # Assignment counts of the transfer
+        self.limiters = [account.canvas_limiter, account.todoist_limiter]
+        self.throttled_before = [limiter.throttled for limiter in self.limiters]
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def span(self, phase):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                self.spans[phase] = self.spans.get(phase, 0) + elapsed
+
+    def observe(self, service, endpoint, status, seconds):
+        with self.lock:
+            self.requests[(service, endpoint, str(status))] += 1
+            histogram = self.latency.setdefault(
+                (service, endpoint), [0] * (len(latency_buckets) + 3)
+            )
+            for i, bound in enumerate(latency_buckets):
+                if seconds <= bound:
+                    histogram[i] += 1
+                    break
+            else:
+                histogram[-3] += 1
+            histogram[-2] += 1
+            histogram[-1] += seconds
+
+    # Seconds each rate limiter spent waiting during this pass
+    def throttled(self):
+        return {
+            limiter.name.lower(): limiter.throttled - before
+            for limiter, before in zip(self.limiters, self.throttled_before)
+        }
+
+    def as_dict(self):
+        with self.lock:
+            return {
+                "account": self.account.name or "default",
+                "started": self.started.isoformat(),
+                "result": self.result,
+                "spans": {
+                    phase: round(seconds, 4) for phase, seconds in self.spans.items()
+                },
+                "requests": [
+                    {
+                        "service": service,
+                        "endpoint": endpoint,
+                        "status": status,
+                        "count": count,
+                    }
+                    for (service, endpoint, status), count in sorted(self.requests.items())
+                ],
+                "latency": [
+                    {
+                        "service": service,
+                        "endpoint": endpoint,
+                        "buckets": dict(
+                            zip(map(str, latency_buckets + ("+Inf",)), histogram[:-2])
+                        ),
+                        "count": histogram[-2],
+                        "sum": round(histogram[-1], 4),
+                    }
+                    for (service, endpoint), histogram in sorted(self.latency.items())
+                ],
+                "throttled": {
+                    name: round(seconds, 3) for name, seconds in self.throttled().items()
+                },
+                "results": dict(self.results),
+            }
+
+
+# Canvas endpoint of a URL with the ids taken out, e.g. /api/v1/courses/:id/assignments
+def canvas_endpoint(url):
+    return re.sub(r"/\d+(?=/|$)", "/:id", urlparse(url).path)
+
+
+# Appends the metrics of the account's last sync to --metrics-log
+def log_metrics(account):
+    if metrics_log_path is None:
+        return
+    line = json.dumps(account.metrics.as_dict())
+    with metrics_lock:
+        if metrics_log_path == "-":
+            print(line)
+        else:
+            with open(metrics_log_path, "a") as log_file:
+                log_file.write(line + "\n")
+
+
+# Writes the metrics of every account's last sync to --prometheus. The file is
+# replaced in one step so a collector never reads it half written
+def write_prometheus(accounts):
+    if prometheus_path is None:
+        return
+    lines = []
+
+    def metric(name, kind, help_text, samples):
+        lines.append(f"# HELP canvas_todoist_{name} {help_text}")
+        lines.append(f"# TYPE canvas_todoist_{name} {kind}")
+        for suffix, labels, value in samples:
+            label_text = ",".join(
+                f'{key}="{prometheus_label(label)}"' for key, label in labels.items()
+            )
+            lines.append(f"canvas_todoist_{name}{suffix}{{{label_text}}} {value}")
+
+    snapshots = [account.metrics.as_dict() for account in accounts]
+    metric(
+        "last_sync_timestamp_seconds",
+        "gauge",
+        "Start of the last sync",
+        [
+            ("", {"account": m["account"]}, datetime.fromisoformat(m["started"]).timestamp())
+            for m in snapshots
+        ],
+    )
+    metric(
+        "last_sync_success",
+        "gauge",
+        "1 if the last sync finished without errors",
+        [("", {"account": m["account"]}, int(m["result"] == "ok")) for m in snapshots],
+    )
+    metric(
+        "phase_seconds",
+        "gauge",
+        "Time spent in each phase of the last sync",
+        [
+            ("", {"account": m["account"], "phase": phase}, seconds)
+            for m in snapshots
+            for phase, seconds in m["spans"].items()
+        ],
+    )
+    metric(
+        "http_requests",
+        "gauge",
+        "HTTP requests sent during the last sync",
+        [
+            (
+                "",
+                {
+                    "account": m["account"],
+                    "service": r["service"],
+                    "endpoint": r["endpoint"],
+                    "status": r["status"],
+                },
+                r["count"],
+            )
+            for m in snapshots
+            for r in m["requests"]
+        ],
+    )
+    samples = []
+    for m in snapshots:
+        for h in m["latency"]:
+            labels = {"account": m["account"], "service": h["service"], "endpoint": h["endpoint"]}
+            cumulative = 0
+            for bound, count in h["buckets"].items():
+                cumulative += count
+                samples.append(("_bucket", dict(labels, le=bound), cumulative))
+            samples.append(("_sum", labels, h["sum"]))
+            samples.append(("_count", labels, h["count"]))
+    metric(
+        "http_request_duration_seconds",
+        "histogram",
+        "Latency of HTTP requests during the last sync",
+        samples,
+    )
+    metric(
+        "throttled_seconds",
+        "gauge",
+        "Time spent waiting on the rate limiters during the last sync",
+        [
+            ("", {"account": m["account"], "service": name}, seconds)
+            for m in snapshots
+            for name, seconds in m["throttled"].items()
+        ],
+    )
+    metric(
+        "assignments",
+        "gauge",
+        "Assignments by outcome in the last sync",
+        [
+            ("", {"account": m["account"], "outcome": outcome}, count)
+            for m in snapshots
+            for outcome, count in m["results"].items()
+        ],
+    )
+    with metrics_lock:
+        with open(prometheus_path + ".tmp", "w") as prometheus_file:
+            prometheus_file.write("\n".join(lines) + "\n")
+        os.replace(prometheus_path + ".tmp", prometheus_path)
+
+
+# Escapes a label value for the Prometheus text format
+def prometheus_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+# Exponential backoff with jitter so concurrent workers do not retry in lockstep
+def retry_delay(attempt):
+    return min(60, 2**attempt) * uniform(0.5, 1.5)
+
+
+# Whether a request failed before any response arrived, e.g. a reset
+# connection or a timeout, so sending it again may well succeed
+def network_error(error):
+    import requests
+
+    return isinstance(error, (requests.ConnectionError, requests.Timeout))
+
+
+# Seconds to wait according to a Retry-After header, if the response sent one
+def retry_after(response):
+    value = response.headers.get("Retry-After")
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+# Canvas answers 403 "Rate Limit Exceeded" when the bucket runs dry
+def canvas_throttled(response):
+    if response.status_code == 429:
+        return True
+    return response.status_code == 403 and "Rate Limit Exceeded" in response.text
+
+
+# Runs a Todoist API call through the account's todoist_limiter, retrying 429s
+# and server errors after Retry-After (or backoff with jitter). Raises once
+# retries run out
+def todoist_request(account, call, *args, cost=1, **kwargs):
+    todoist_limiter = account.todoist_limiter
+    endpoint = call.__name__.removeprefix("todoist_")
+    for attempt in range(max_retries + 1):
+        todoist_limiter.acquire(cost)
+        start = time.perf_counter()
+        try:
+            result = call(*args, **kwargs)
+            account.metrics.observe("todoist", endpoint, 200, time.perf_counter() - start)
+            return result
+        except Exception as error:
+            response = getattr(error, "response", None)
+            status = getattr(response, "status_code", None)
+            account.metrics.observe(
+                "todoist", endpoint, status or "error", time.perf_counter() - start
+            )
+            if network_error(error) and attempt < max_retries:
+                delay = retry_delay(attempt)
+                account.log(
+                    f"Todoist request failed ({error}), retrying in {delay:.1f} seconds..."
+                )
+                time.sleep(delay)
+                continue
+            retryable = status == 429 or (status is not None and status >= 500)
+            if not retryable or attempt == max_retries:
+                raise
+            todoist_limiter.back_off(retry_after(response) or retry_delay(attempt))
+        finally:
+            todoist_limiter.settle(cost)
 
 
 if __name__ == "__main__":